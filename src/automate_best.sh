@@ -1,5 +1,4 @@
 jupyter nbconvert Train.ipynb --to python
-jupyter nbconvert recon_inference_mi.ipynb --to python
 jupyter nbconvert final_evaluations_mi_multi.ipynb --to python
 jupyter nbconvert plots_across_subjects.ipynb --to python
 jupyter nbconvert plots_across_methods.ipynb --to python
@@ -16,7 +15,7 @@ for subj in 1; do
 
     for mode in "vision" "imagery" "shared1000"; do #
 
-        python recon_inference_mi.py \
+        python reconstruct.py \
             --model_name $model_name \
             --subj $subj \
             --mode $mode \
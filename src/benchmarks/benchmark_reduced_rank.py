@@ -0,0 +1,130 @@
+# Compares reduced-rank ridge heads against the full-rank model for the VDVAE latent head:
+# checkpoint size, prediction latency and held-out latent metrics for each rank.
+# Uses synthetic data by default. With --data_path, fits on the subject's NSD betas and the VDVAE
+# latent embedding bank that Train.ipynb gathers its targets from, holding out the last
+# --holdout_fraction of training images, and with --cache_dir also decodes the held-out
+# predictions with VDVAE to compare reconstructions.
+# Run from the src directory: python benchmarks/benchmark_reduced_rank.py --ranks 64 256 1024
+import os
+import sys
+import time
+import tempfile
+import argparse
+import numpy as np
+import torch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ridge import RidgeSolver, RidgeDecoder, save_ridge_weights
+
+parser = argparse.ArgumentParser(description="Benchmark reduced-rank ridge for the VDVAE latent head")
+parser.add_argument("--ranks", type=int, nargs="+", default=[16, 64, 256])
+parser.add_argument("--alpha", type=float, default=60000)
+parser.add_argument("--num_train", type=int, default=4000)
+parser.add_argument("--num_test", type=int, default=500)
+parser.add_argument("--num_voxels", type=int, default=4000)
+parser.add_argument("--num_targets", type=int, default=91168)
+parser.add_argument(
+    "--signal_rank", type=int, default=128,
+    help="Rank of the synthetic voxel-to-latent mapping",
+)
+parser.add_argument(
+    "--data_path", type=str, default=None,
+    help="Use real NSD betas and VDVAE latent embeddings from this directory instead of synthetic data",
+)
+parser.add_argument("--subj", type=int, default=1)
+parser.add_argument("--num_sessions", type=int, default=40)
+parser.add_argument("--holdout_fraction", type=float, default=0.1)
+parser.add_argument(
+    "--cache_dir", type=str, default=None,
+    help="With --data_path, decode held-out predictions with VDVAE weights from this directory",
+)
+parser.add_argument("--num_recons", type=int, default=16)
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+parser.add_argument("--num_runs", type=int, default=3)
+parser.add_argument("--seed", type=int, default=42)
+args = parser.parse_args()
+
+
+def synthetic_data():
+    generator = torch.Generator().manual_seed(args.seed)
+    n = args.num_train + args.num_test
+    x = torch.randn((n, args.num_voxels), generator=generator)
+    mapping = torch.randn((args.num_voxels, args.signal_rank), generator=generator) @ torch.randn((args.signal_rank, args.num_targets), generator=generator)
+    y = x @ mapping / np.sqrt(args.num_voxels * args.signal_rank) + torch.randn((n, args.num_targets), generator=generator)
+    return x[:args.num_train], y[:args.num_train], x[args.num_train:], y[args.num_train:]
+
+
+def nsd_data():
+    import utils
+    x_train, valid_nsd_ids_train, _, _ = utils.load_nsd(subject=args.subj, num_sessions=args.num_sessions, data_path=args.data_path)
+    # VDVAE latent targets gathered from the shared bank, as in Train.ipynb; build it with extract_embeddings.py --kind latent
+    y = utils.gather_embedding_bank(utils.load_embedding_bank(utils.embedding_bank_path(args.data_path, "vdvae", "latent")), valid_nsd_ids_train)
+    # Hold out whole images, so repeats of a held-out image are never trained on
+    unique_ids = np.unique(valid_nsd_ids_train)
+    held_out = np.isin(valid_nsd_ids_train, unique_ids[int(len(unique_ids) * (1 - args.holdout_fraction)):])
+    train, test = torch.from_numpy(~held_out), torch.from_numpy(held_out)
+    return x_train[train], y[train], x_train[test], y[test]
+
+
+def time_predict(path, x):
+    times = []
+    for _ in range(args.num_runs):
+        start = time.perf_counter()
+        pred = RidgeDecoder(path, device=args.device).predict(x)
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return pred, min(times)
+
+
+def latent_metrics(pred, target):
+    pred_c = pred - pred.mean(dim=0)
+    target_c = target - target.mean(dim=0)
+    corr = (pred_c * target_c).sum(dim=0) / (pred_c.norm(dim=0) * target_c.norm(dim=0) + 1e-8)
+    return torch.mean((pred - target) ** 2).item(), corr.mean().item()
+
+
+def pixel_correlation(a, b):
+    a = a.reshape(len(a), -1) - a.reshape(len(a), -1).mean(dim=1, keepdim=True)
+    b = b.reshape(len(b), -1) - b.reshape(len(b), -1).mean(dim=1, keepdim=True)
+    return ((a * b).sum(dim=1) / (a.norm(dim=1) * b.norm(dim=1))).mean().item()
+
+
+x_train, y_train, x_test, y_test = nsd_data() if args.data_path else synthetic_data()
+print(f"train: {tuple(x_train.shape)} -> {tuple(y_train.shape)}, test: {tuple(x_test.shape)}, device: {args.device}")
+
+start = time.perf_counter()
+solver = RidgeSolver(x_train, device=args.device)
+coef, intercept = solver.solve(y_train, alpha=args.alpha)
+print(f"full-rank fit: {time.perf_counter() - start:.1f}s")
+
+vdvae = None
+if args.data_path and args.cache_dir:
+    from torchvision import transforms
+    from vdvae import VDVAE
+    vdvae = VDVAE(device=args.device, cache_dir=args.cache_dir)
+
+
+def reconstruct(pred):
+    return torch.stack([transforms.ToTensor()(vdvae.reconstruct(latents=latent.unsqueeze(0))) for latent in pred[:args.num_recons]])
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    full_path = f"{tmpdir}/full.safetensors"
+    save_ridge_weights(full_path, coef, intercept, "vdvae", (y_train.shape[1],))
+    full_pred, full_time = time_predict(full_path, x_test)
+    full_mse, full_corr = latent_metrics(full_pred, y_test)
+    full_recons = reconstruct(full_pred) if vdvae else None
+    print(f"{'rank':>6} {'size MB':>9} {'predict s':>10} {'test MSE':>10} {'mean r':>8} {'rel. diff':>10}" + (f" {'recon r':>8}" if vdvae else ""))
+    print(f"{'full':>6} {os.path.getsize(full_path) / 2**20:>9.1f} {full_time:>10.3f} {full_mse:>10.4f} {full_corr:>8.4f} {0:>10.4f}" + (f" {1:>8.4f}" if vdvae else ""))
+    for rank in args.ranks:
+        path = f"{tmpdir}/rank{rank}.safetensors"
+        u, v, reduced_intercept = solver.reduce_rank(coef, intercept, rank)
+        save_ridge_weights(path, (u, v), reduced_intercept, "vdvae", (y_train.shape[1],))
+        pred, pred_time = time_predict(path, x_test)
+        mse, corr = latent_metrics(pred, y_test)
+        rel_diff = ((pred - full_pred).norm() / full_pred.norm()).item()
+        line = f"{rank:>6} {os.path.getsize(path) / 2**20:>9.1f} {pred_time:>10.3f} {mse:>10.4f} {corr:>8.4f} {rel_diff:>10.4f}"
+        if vdvae:
+            # Pixel correlation of the reduced-rank reconstructions with the full-rank ones
+            line += f" {pixel_correlation(reconstruct(pred), full_recons):>8.4f}"
+        print(line)
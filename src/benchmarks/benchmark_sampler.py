@@ -0,0 +1,173 @@
+# Sweeps the Stage C and Stage B sampler settings of SC_Reconstructor over a fixed set of predicted
+# embeddings, recording wall-clock, peak GPU memory and reconstruction metrics for each setting:
+# PixCorr and SSIM as in final_evaluations_mi_multi.ipynb, AlexNet(2)/(5) two-way identification,
+# and the CLIP cosine similarity between the reconstructions and the ground truth images.
+# Every setting sees the same per-batch seeds. The named presets of reconstruct.py are benchmarked,
+# together with every combination of the values given for the sweep arguments, which default to the
+# --base_preset values. Any other argument is passed on to reconstruct.py, e.g. --num_images_per_sample.
+# Run from the src directory after training a model:
+#   python benchmarks/benchmark_sampler.py --data_path=../dataset --cache_dir=../cache --model_name=subj01_40sess_hypatia_mirage --mode vision
+#   python benchmarks/benchmark_sampler.py ... --presets --num_steps_c 10 20 30 --num_steps_b 4 10 --output sweep.csv
+# With --save_recons, the reconstructions of each setting are saved for the full final_evaluations_mi_multi.ipynb metrics.
+import os
+import sys
+import csv
+import time
+import argparse
+import itertools
+import numpy as np
+import torch
+from torchvision import transforms
+from tqdm import tqdm
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import reconstruct
+from reconstruct import SAMPLER_PRESETS
+
+parser = argparse.ArgumentParser(description="Benchmark Stable Cascade sampler settings")
+parser.add_argument(
+    "--presets", type=str, nargs="*", default=list(SAMPLER_PRESETS), choices=list(SAMPLER_PRESETS),
+    help="Named presets to benchmark; pass no names to only run the sweep",
+)
+parser.add_argument("--base_preset", type=str, default="balanced", choices=list(SAMPLER_PRESETS))
+parser.add_argument("--num_steps_c", type=int, nargs="+", default=None)
+parser.add_argument("--num_steps_b", type=int, nargs="+", default=None)
+parser.add_argument("--shift_c", type=float, nargs="+", default=None)
+parser.add_argument("--shift_b", type=float, nargs="+", default=None)
+parser.add_argument("--cfg_c", type=float, nargs="+", default=None)
+parser.add_argument("--cfg_b", type=float, nargs="+", default=None)
+parser.add_argument(
+    "--num_samples", type=int, default=12,
+    help="Number of test samples reconstructed with each setting, from the first",
+)
+parser.add_argument("--output", type=str, default=None, help="CSV file the results are written to")
+parser.add_argument("--save_recons", action="store_true")
+args, recon_argv = parser.parse_known_args()
+recon_args = reconstruct.parse_args(recon_argv)
+if not recon_args.blurry_recon:
+    recon_args.strength = 1.0
+if not recon_args.retrieval:
+    recon_args.num_images_per_sample = 1
+device = recon_args.device
+num_candidates = recon_args.num_images_per_sample if recon_args.num_images_per_sample > 1 else recon_args.gen_rep
+samples_per_batch = max(1, recon_args.recon_batch_size // num_candidates)
+
+configs = {name: SAMPLER_PRESETS[name] for name in args.presets}
+sweep = {key: getattr(args, key) or [value] for key, value in SAMPLER_PRESETS[args.base_preset].items()}
+if any(getattr(args, key) for key in sweep):
+    for values in itertools.product(*sweep.values()):
+        sampler = dict(zip(sweep, values))
+        configs[" ".join(f"{key}={value}" for key, value in sampler.items() if getattr(args, key))] = sampler
+
+
+def load_inputs():
+    voxels, all_images = reconstruct.load_data(recon_args)
+    voxels, all_images = voxels[:args.num_samples], all_images[:args.num_samples]
+    preds_path = f"evals/{recon_args.model_name}/{recon_args.model_name}_preds_{recon_args.mode}.pt"
+    if os.path.exists(preds_path):
+        # Saved by reconstruct.py
+        preds = {name: pred[:args.num_samples].to(device) for name, pred in torch.load(preds_path).items()}
+    else:
+        preds = reconstruct.predict_heads(recon_args, voxels)
+    return preds, all_images.float()
+
+
+def pixcorr(images, recons):
+    resize = transforms.Resize(512, interpolation=transforms.InterpolationMode.BILINEAR, antialias=True)
+    images, recons = resize(images).flatten(1).numpy(), resize(recons).flatten(1).numpy()
+    return np.mean([np.corrcoef(image, recon)[0, 1] for image, recon in zip(images, recons)])
+
+
+def ssim(images, recons):
+    from skimage.color import rgb2gray
+    from skimage.metrics import structural_similarity
+    resize = transforms.Resize(512, interpolation=transforms.InterpolationMode.BILINEAR, antialias=True)
+    images, recons = rgb2gray(resize(images).permute(0, 2, 3, 1).numpy()), rgb2gray(resize(recons).permute(0, 2, 3, 1).numpy())
+    return np.mean([structural_similarity(recon, image, gaussian_weights=True, sigma=1.5, use_sample_covariance=False, data_range=1.0)
+                    for image, recon in zip(images, recons)])
+
+
+def two_way_identification(real_features, recon_features):
+    # Fraction of the other ground truth images each reconstruction correlates with less than with its own
+    n = len(real_features)
+    r = np.corrcoef(real_features.flatten(1).float().cpu().numpy(), recon_features.flatten(1).float().cpu().numpy())[:n, n:]
+    return np.mean([np.sum(r[:, i] < r[i, i]) / (n - 1) for i in range(n)])
+
+
+alexnet = None
+
+
+def alexnet_identification(images, recons):
+    global alexnet
+    from torchvision.models import alexnet as alexnet_model, AlexNet_Weights
+    from torchvision.models.feature_extraction import create_feature_extractor
+    if alexnet is None:
+        alexnet = create_feature_extractor(alexnet_model(weights=AlexNet_Weights.IMAGENET1K_V1), return_nodes=['features.4', 'features.11'])
+        alexnet.to(device).eval().requires_grad_(False)
+    preprocess = transforms.Compose([
+        transforms.Resize(256, interpolation=transforms.InterpolationMode.BILINEAR, antialias=True),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+    with torch.no_grad():
+        reals, fakes = alexnet(preprocess(images).to(device)), alexnet(preprocess(recons).to(device))
+    return tuple(two_way_identification(reals[layer], fakes[layer]) for layer in ('features.4', 'features.11'))
+
+
+def clip_cosine(reconstructor, images, recons):
+    with torch.no_grad():
+        embeds = [reconstructor.embed_image(reconstructor.prepare_images(x)).float().flatten(1) for x in (images, recons)]
+    return torch.nn.functional.cosine_similarity(*embeds).mean().item()
+
+
+def run(models, preds, sampler, num_samples):
+    # The first rep of every sample, in the batches reconstruct.py would run
+    recons = []
+    for start in range(0, num_samples, samples_per_batch):
+        end = min(start + samples_per_batch, num_samples)
+        recons.append(reconstruct.generate_batch(recon_args, models, preds, 0, start, end, device, sampler=sampler)[4][:, 0].float().cpu())
+    return torch.cat(recons)
+
+
+preds, all_images = load_inputs()
+args.num_samples = len(all_images)
+if args.num_samples < 2:
+    raise ValueError("Two-way identification needs at least 2 samples")
+models = reconstruct.load_models(recon_args, device)
+cuda = str(device).startswith("cuda")
+print(f"{args.num_samples} samples of {recon_args.model_name} {recon_args.mode}, {len(configs)} settings, device: {device}")
+# Warm up, so that compilation with --compile_models is not timed
+run(models, preds, SAMPLER_PRESETS["fast"], min(samples_per_batch, args.num_samples))
+
+results = []
+for name, sampler in tqdm(configs.items(), desc="settings"):
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    recons = run(models, preds, sampler, args.num_samples)
+    if cuda:
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    if args.save_recons:
+        os.makedirs(f"evals/{recon_args.model_name}/benchmark_sampler", exist_ok=True)
+        torch.save(recons.unsqueeze(1), f"evals/{recon_args.model_name}/benchmark_sampler/{name.replace(' ', '_')}_{recon_args.mode}.pt")
+    alexnet2, alexnet5 = alexnet_identification(all_images, recons)
+    results.append({"setting": name, **sampler,
+                    "seconds": seconds,
+                    "seconds_per_image": seconds / args.num_samples,
+                    "peak_memory_GB": torch.cuda.max_memory_allocated(device) / 2**30 if cuda else float("nan"),
+                    "pixcorr": pixcorr(all_images, recons),
+                    "ssim": ssim(all_images, recons),
+                    "alexnet2": alexnet2,
+                    "alexnet5": alexnet5,
+                    "clip_cosine": clip_cosine(models[0], all_images, recons)})
+
+columns = ["seconds_per_image", "peak_memory_GB", "pixcorr", "ssim", "alexnet2", "alexnet5", "clip_cosine"]
+width = max(len(result["setting"]) for result in results)
+print(f"{'setting':>{width}} " + " ".join(f"{column:>{max(len(column), 8)}}" for column in columns))
+for result in results:
+    print(f"{result['setting']:>{width}} " + " ".join(f"{result[column]:>{max(len(column), 8)}.4f}" for column in columns))
+if args.output:
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
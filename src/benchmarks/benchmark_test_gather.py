@@ -0,0 +1,64 @@
+# Compares the vectorized shared1000 test-set gather in utils.load_nsd against the
+# original nested per-row loop on synthetic betas.
+# Run from the src directory: python benchmarks/benchmark_test_gather.py
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import utils
+
+parser = argparse.ArgumentParser(description="Benchmark test-set beta gathering")
+parser.add_argument("--num_scans", type=int, default=30000)
+parser.add_argument("--num_voxels", type=int, default=15724)
+parser.add_argument("--num_test_trials", type=int, default=1000)
+parser.add_argument("--num_repeats", type=int, default=3)
+parser.add_argument(
+    "--missing_fraction", type=float, default=0.1,
+    help="Fraction of repeats marked invalid, mimicking subjects that did not complete all sessions",
+)
+parser.add_argument("--num_runs", type=int, default=3)
+parser.add_argument("--seed", type=int, default=42)
+args = parser.parse_args()
+
+
+def loop_gather(betas, scan_ids_test):
+    # The original implementation from utils.load_nsd
+    num_test_trials, num_repeats = scan_ids_test.shape
+    x_test = torch.zeros((num_test_trials, num_repeats, betas.shape[1]), dtype=betas.dtype)
+    for i in range(num_test_trials):
+        for j in range(num_repeats):
+            scan_id = scan_ids_test[i, j]
+            if scan_id >= 0:
+                x_test[i, j] = betas[int(scan_id)]
+    return x_test
+
+
+def vectorized_gather(betas, scan_ids_test):
+    return utils.gather_betas_masked(betas, scan_ids_test, scan_ids_test >= 0, fill_value=0.0)
+
+
+def time_fn(fn, *fn_args):
+    times = []
+    for _ in range(args.num_runs):
+        start = time.perf_counter()
+        out = fn(*fn_args)
+        times.append(time.perf_counter() - start)
+    return out, min(times)
+
+
+rng = np.random.default_rng(args.seed)
+betas = torch.randn((args.num_scans, args.num_voxels), generator=torch.Generator().manual_seed(args.seed))
+scan_ids_test = rng.choice(args.num_scans, size=(args.num_test_trials, args.num_repeats), replace=False).astype(float)
+scan_ids_test[rng.random(scan_ids_test.shape) < args.missing_fraction] = -1
+print(f"betas: {tuple(betas.shape)}, test scan IDs: {scan_ids_test.shape}, invalid: {(scan_ids_test < 0).sum()}")
+
+x_loop, t_loop = time_fn(loop_gather, betas, scan_ids_test)
+x_vec, t_vec = time_fn(vectorized_gather, betas, scan_ids_test)
+assert torch.equal(x_loop, x_vec), "vectorized gather does not match the loop"
+
+print(f"loop:       {t_loop:.3f}s")
+print(f"vectorized: {t_vec:.3f}s")
+print(f"speedup:    {t_loop / t_vec:.1f}x")
@@ -0,0 +1,187 @@
+# Builds the shared 73k NSD embedding banks that Train.ipynb gathers its training targets from.
+# Banks are written in resumable shards, so rerunning the same command after a crash picks up
+# after the last finished shard. Examples, from the src directory:
+#   python extract_embeddings.py --data_path=../dataset --cache_dir=../cache --kind image
+#   python extract_embeddings.py --data_path=../dataset --cache_dir=../cache --kind latent --gpus 0 1 2 3
+# --gpus launches one worker process per GPU and consolidates the bank once they all finish.
+# --kind git instead builds git_image_features.hdf5, the GIT vision features used for prompt recon.
+import os
+import sys
+import argparse
+import subprocess
+import h5py
+import numpy as np
+import torch
+from tqdm import tqdm
+import utils
+
+# Embedding variant of each bank kind, as named in Train.ipynb and recon_inference_mi.ipynb
+BANK_VARIANTS = {"image": "stable_cascade", "retrieval": "stable_cascade_hidden", "latent": "vdvae", "text": "stable_cascade"}
+CAPTION_FILES = {"coco": "annots_73k.npy", "short": "short_length_captions.npy", "medium": "mid_length_captions_73K.npy"}
+
+
+def bank_path(data_path, kind, caption_type="medium"):
+    variant = BANK_VARIANTS[kind]
+    if kind == "text" and caption_type != "coco":
+        variant += f"_{caption_type}"
+    return utils.embedding_bank_path(data_path, variant, kind)
+
+
+def make_embed_fn(kind, images=None, captions=None, clip_extractor=None, vdvae=None):
+    """Returns the embed_fn for utils.create_embedding_bank that embeds a range of NSD image IDs."""
+    if kind == "image":
+        return lambda start, end: clip_extractor.embed_image(clip_extractor.prepare_images(torch.from_numpy(images[start:end])))
+    if kind == "retrieval":
+        # Normalized for optimal cosine similarity
+        return lambda start, end: torch.nn.functional.normalize(
+            clip_extractor.embed_image(clip_extractor.prepare_images(torch.from_numpy(images[start:end])), hidden=True).float(), p=2, dim=2)
+    if kind == "latent":
+        return lambda start, end: vdvae.embed_latent(torch.from_numpy(images[start:end]))
+    if kind == "text":
+        return lambda start, end: clip_extractor.embed_text(captions[start:end].tolist())
+    raise ValueError(f"Unknown embedding bank kind {kind}")
+
+
+def build_bank(kind, data_path, cache_dir, caption_type="medium", device="cuda", batch_size=50, shard_size=1024,
+               worker_id=0, num_workers=1, consolidate=True, clip_extractor=None, vdvae=None, dtype=np.float32):
+    """Creates or resumes the embedding bank of one kind, loading the embedding model unless one is passed in.
+
+    Banks are float32 like the per-subject training targets they replace; pass dtype=np.float16 to halve their size.
+    """
+    path = bank_path(data_path, kind, caption_type)
+    if os.path.exists(path):
+        return path
+    if kind == "latent" and vdvae is None:
+        from vdvae import VDVAE
+        vdvae = VDVAE(device=device, cache_dir=cache_dir)
+    elif kind != "latent" and clip_extractor is None:
+        from sc_reconstructor import SC_Reconstructor
+        clip_extractor = SC_Reconstructor(compile_models=False, embedder_only=True, device=device, cache_dir=cache_dir)
+    with h5py.File(f'{data_path}/coco_images_224_float16.hdf5', 'r') as f:
+        images = f['images']
+        captions = np.load(f'{data_path}/preprocessed_data/{CAPTION_FILES[caption_type]}') if kind == "text" else None
+        embed_fn = make_embed_fn(kind, images=images, captions=captions, clip_extractor=clip_extractor, vdvae=vdvae)
+        utils.create_embedding_bank(path, embed_fn, len(images), batch_size=batch_size, dtype=dtype, shard_size=shard_size,
+                                    worker_id=worker_id, num_workers=num_workers, consolidate=consolidate)
+    return path
+
+
+def create_git_features(data_path, device="cuda", batch_size=64, processor=None, git_text_model=None):
+    """Streams GIT vision features of all 73k NSD images into a chunked fp16 git_image_features.hdf5.
+
+    Images are normalized and encoded on the device in batches, and each batch is written straight
+    to the 'features' dataset of shape (73000, 1, 257, 1024), so the ~77 GB float32 feature tensor
+    is never held in memory. The file is written to a temporary name and renamed when complete.
+    """
+    path = f'{data_path}/git_image_features.hdf5'
+    if processor is None:
+        from transformers import AutoProcessor
+        processor = AutoProcessor.from_pretrained("microsoft/git-large-coco")
+    if git_text_model is None:
+        from modeling_git import GitForCausalLMClipEmb
+        git_text_model = GitForCausalLMClipEmb.from_pretrained("microsoft/git-large-coco")
+        git_text_model.to(device)
+        git_text_model.eval().requires_grad_(False)
+    crop_size = processor.image_processor.crop_size
+    mean = torch.tensor(processor.image_processor.image_mean, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(processor.image_processor.image_std, device=device).view(1, 3, 1, 1)
+    with h5py.File(f'{data_path}/coco_images_224_float16.hdf5', 'r') as f, h5py.File(path + ".tmp", 'w') as out:
+        images = f['images']
+        features = None
+        for start in tqdm(range(0, len(images), batch_size), desc="Extracting GIT features"):
+            batch = images[start:start + batch_size]
+            if tuple(batch.shape[-2:]) == (crop_size["height"], crop_size["width"]):
+                # Already at the processor's crop size, so resizing and cropping are no-ops; quantize to
+                # 8 bits like the uint8 images the processor was given, then rescale and normalize
+                pixel_values = (torch.from_numpy(batch).to(device) * 255).floor().float() / 255
+                pixel_values = (pixel_values - mean) / std
+            else:
+                pixel_values = processor(images=list((batch.transpose((0, 2, 3, 1)) * 255).astype(np.uint8)), return_tensors="pt").pixel_values.to(device)
+            with torch.no_grad():
+                outputs = git_text_model.git.image_encoder(pixel_values).last_hidden_state
+            if features is None:
+                features = out.create_dataset('features', shape=(len(images), 1) + tuple(outputs.shape[1:]), dtype='float16',
+                                              chunks=(1, 1) + tuple(outputs.shape[1:]))
+                # valid the captions
+                generated_ids = git_text_model.generate(pixel_values=outputs[:6], max_length=50)
+                print(processor.batch_decode(generated_ids, skip_special_tokens=True))
+            features[start:start + len(outputs), 0] = outputs.half().cpu().numpy()
+    os.replace(path + ".tmp", path)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a shared 73k NSD embedding bank")
+    parser.add_argument(
+        "--data_path", type=str, default=os.getcwd(),
+        help="Path to where NSD data is stored",
+    )
+    parser.add_argument(
+        "--cache_dir", type=str, default=os.getcwd(),
+        help="Path to where misc. files downloaded from huggingface are stored",
+    )
+    parser.add_argument(
+        "--kind", type=str, required=True, choices=list(BANK_VARIANTS) + ["git"],
+    )
+    parser.add_argument(
+        "--caption_type", type=str, default="medium", choices=list(CAPTION_FILES),
+        help="Caption file embedded by --kind text",
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=50,
+    )
+    parser.add_argument(
+        "--dtype", type=str, default="float32", choices=["float32", "float16"],
+        help="Storage dtype of the bank; float16 halves its size but quantizes the training targets",
+    )
+    parser.add_argument(
+        "--shard_size", type=int, default=1024,
+    )
+    parser.add_argument(
+        "--device", type=str, default="cuda",
+    )
+    parser.add_argument(
+        "--worker_id", type=int, default=0,
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=1,
+        help="Number of processes splitting the shards; run again with --consolidate once they have all finished",
+    )
+    parser.add_argument(
+        "--consolidate", action="store_true",
+        help="Only merge the finished shards of the bank",
+    )
+    parser.add_argument(
+        "--gpus", type=int, nargs="+", default=None,
+        help="Launch one worker per listed GPU and consolidate when they are all done",
+    )
+    args = parser.parse_args()
+
+    if args.kind == "git":
+        print(f"{create_git_features(args.data_path, device=args.device, batch_size=args.batch_size)} is ready")
+        sys.exit(0)
+
+    path = bank_path(args.data_path, args.kind, args.caption_type)
+    if args.consolidate:
+        utils.consolidate_embedding_bank(path)
+    elif args.gpus is not None:
+        workers = []
+        for worker_id, gpu in enumerate(args.gpus):
+            command = [sys.executable, os.path.abspath(__file__), f"--data_path={args.data_path}", f"--cache_dir={args.cache_dir}",
+                       f"--kind={args.kind}", f"--caption_type={args.caption_type}", f"--batch_size={args.batch_size}",
+                       f"--shard_size={args.shard_size}", f"--dtype={args.dtype}", f"--worker_id={worker_id}", f"--num_workers={len(args.gpus)}", "--device=cuda"]
+            workers.append(subprocess.Popen(command, env={**os.environ, "CUDA_VISIBLE_DEVICES": str(gpu)}))
+        failed = [gpu for gpu, worker in zip(args.gpus, workers) if worker.wait() != 0]
+        if failed:
+            sys.exit(f"Workers on GPUs {failed} failed; rerun the same command to resume their shards")
+        if not os.path.exists(path):
+            utils.consolidate_embedding_bank(path)
+    else:
+        build_bank(args.kind, args.data_path, args.cache_dir, caption_type=args.caption_type, device=args.device,
+                   batch_size=args.batch_size, shard_size=args.shard_size, worker_id=args.worker_id,
+                   num_workers=args.num_workers, consolidate=args.num_workers == 1, dtype=np.dtype(args.dtype))
+    if os.path.exists(path):
+        print(f"{path} is ready")
+    else:
+        finished, missing = utils.embedding_bank_progress(path)
+        print(f"{len(finished)} of {len(finished) + len(missing)} shards of {path} are finished")
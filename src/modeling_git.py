@@ -1800,8 +1800,59 @@ class GitForCausalLMClipEmb(GitPreTrainedModel):
         for layer_past in past_key_values:
             reordered_past += (tuple(past_state.index_select(0, beam_idx) for past_state in layer_past),)
         return reordered_past
-    
-    
+
+    @torch.no_grad()
+    def generate_captions(self, image_embeds, max_length=20, batch_size=256):
+        """Greedy captioning of precomputed GIT vision features in batches.
+
+        Matches `generate(pixel_values=image_embeds, max_length=max_length)`, but the image tokens only
+        attend to each other, so their keys/values are computed once per batch and kept in the cache
+        instead of being re-encoded through every layer at each decoding step. Runs in the model's
+        dtype, so load the model with `torch_dtype=torch.float16` or `torch.bfloat16` for half precision.
+
+        Args:
+            image_embeds: (N, 257, 1024) GIT vision features, on any device.
+            max_length: Maximum caption length in tokens, including the BOS token.
+            batch_size: Number of captions decoded at once.
+
+        Returns:
+            (N, max_length) generated token IDs, padded with the pad token after EOS.
+        """
+        bos_token_id = self.generation_config.bos_token_id
+        eos_token_id = self.generation_config.eos_token_id
+        pad_token_id = self.generation_config.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = eos_token_id
+        all_ids = torch.full((len(image_embeds), max_length), pad_token_id, dtype=torch.long)
+        for start in range(0, len(image_embeds), batch_size):
+            embeds = image_embeds[start:start + batch_size].to(self.device, self.dtype)
+            ids = torch.full((len(embeds), 1), bos_token_id, dtype=torch.long, device=self.device)
+            done = torch.zeros(len(embeds), dtype=torch.bool, device=self.device)
+
+            # Prefill: image tokens plus BOS, keeping the image keys/values in the cache (pixel_values_present=False)
+            memory = self.git.visual_projection(embeds)
+            tgt = self.git.embeddings(input_ids=ids)
+            attention_mask = self.git.create_attention_mask(
+                tgt=tgt, memory=memory, tgt_mask=self.git._generate_future_mask(1, tgt.dtype, tgt.device), past_key_values_length=0
+            )
+            outputs = self.git.encoder(torch.cat((memory, tgt), dim=1), attention_mask=attention_mask, use_cache=True)
+            past_key_values = outputs.past_key_values
+            logits = self.output(outputs.last_hidden_state[:, -1])
+            for step in range(1, max_length):
+                next_ids = logits.argmax(dim=-1).masked_fill(done, pad_token_id)
+                ids = torch.cat((ids, next_ids[:, None]), dim=1)
+                done |= next_ids == eos_token_id
+                if step == max_length - 1 or done.all():
+                    break
+                # A single new token attends to every cached token, so it needs no attention mask
+                hidden_states = self.git.embeddings(input_ids=next_ids[:, None], position_ids=ids.new_full((1, 1), step))
+                outputs = self.git.encoder(hidden_states, past_key_values=past_key_values, use_cache=True)
+                past_key_values = outputs.past_key_values
+                logits = self.output(outputs.last_hidden_state[:, -1])
+            all_ids[start:start + len(embeds), :ids.shape[1]] = ids.cpu()
+        return all_ids
+
+
 class GitModelClipEmb(GitPreTrainedModel):
     def __init__(self, config):
         super().__init__(config)
@@ -0,0 +1,483 @@
+# End-to-end reconstruction from a trained model, the scripted equivalent of recon_inference_mi.ipynb.
+# The main thread decodes the VDVAE low-level images, runs Stable Cascade and CLIP ranking on the GPU,
+# a batch of samples at a time, and a writer thread moves the reconstructions to the host and saves
+# them. A bounded queue to the writer keeps the GPU busy without letting finished images pile up in
+# memory. Reconstructions are appended to on-disk stores as they finish (see utils.create_recon_store)
+# and exported to the same evals/{model_name}/ files as the notebook at the end. Every batch is seeded
+# from --seed and its position, so rerunning an interrupted command with --resume only generates the
+# missing batches and gives the same outputs as an uninterrupted run. Stable Cascade draws its noise
+# for a whole batch at once, so the outputs also depend on how the samples are batched; the batches
+# follow from the recorded settings, so --resume refuses a store started with other batch sizes. With
+# several --devices, one worker process per device generates the batches instead, taking the next one
+# from a shared queue whenever it finishes, and the main process writes them to the same stores. Run
+# from the src directory:
+#   python reconstruct.py --data_path=../dataset --cache_dir=../cache --model_name=subj01_40sess_hypatia_mirage --subj=1 --mode vision
+#   python reconstruct.py ... --mode shared1000 --devices cuda:0 cuda:1 cuda:2 cuda:3
+import os
+import queue
+import argparse
+import threading
+import traceback
+import numpy as np
+import torch
+from torchvision import transforms
+from tqdm import tqdm
+import utils
+from ridge import FusedRidgeDecoder
+
+# SC_Reconstructor.reconstruct_batch sampler settings of --sampler_preset. balanced is the Stable Cascade
+# default the reconstructions were tuned with; compare them with benchmarks/benchmark_sampler.py
+SAMPLER_PRESETS = {
+    "fast": {"num_steps_c": 10, "num_steps_b": 5, "cfg_c": 4, "cfg_b": 1.1, "shift_c": 2, "shift_b": 1},
+    "balanced": {"num_steps_c": 20, "num_steps_b": 10, "cfg_c": 4, "cfg_b": 1.1, "shift_c": 2, "shift_b": 1},
+    "quality": {"num_steps_c": 30, "num_steps_b": 15, "cfg_c": 4, "cfg_b": 1.1, "shift_c": 2, "shift_b": 1},
+}
+
+# Arguments that do not change the outputs, so a run can be resumed with different values. --compile_models
+# is not one of them, as it pads the Stable Cascade batches to the compiled sizes, which changes the noise drawn.
+RUNTIME_ARGS = ("resume", "queue_size", "device", "devices", "save_raw", "raw_path")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reconstruct images from the ridge heads of a trained model")
+    parser.add_argument(
+        "--model_name", type=str, default="testing",
+        help="will load ckpt for model found in ../train_logs/model_name",
+    )
+    parser.add_argument(
+        "--data_path", type=str, default=os.getcwd(),
+        help="Path to where NSD data is stored / where to download it to",
+    )
+    parser.add_argument(
+        "--cache_dir", type=str, default=os.getcwd(),
+        help="Path to where misc. files downloaded from huggingface are stored. Defaults to current src directory.",
+    )
+    parser.add_argument(
+        "--subj", type=int, default=1, choices=[1, 2, 3, 4, 5, 6, 7, 8],
+    )
+    parser.add_argument(
+        "--blurry_recon", action=argparse.BooleanOptionalAction, default=True,
+    )
+    parser.add_argument(
+        "--seed", type=int, default=42,
+        help="Base seed that every batch of samples derives its own seed from",
+    )
+    parser.add_argument(
+        "--mode", type=str, default="vision", choices=["vision", "imagery", "shared1000"],
+    )
+    parser.add_argument(
+        "--gen_rep", type=int, default=10,
+    )
+    parser.add_argument(
+        "--dual_guidance", action=argparse.BooleanOptionalAction, default=True,
+    )
+    parser.add_argument(
+        "--normalize_preds", action=argparse.BooleanOptionalAction, default=True,
+    )
+    parser.add_argument(
+        "--save_raw", action=argparse.BooleanOptionalAction, default=False,
+    )
+    parser.add_argument(
+        "--raw_path", type=str,
+    )
+    parser.add_argument(
+        "--strength", type=float, default=0.70,
+    )
+    parser.add_argument(
+        "--textstrength", type=float, default=0.5,
+    )
+    parser.add_argument(
+        "--filter_contrast", action=argparse.BooleanOptionalAction, default=True,
+        help="Filter the low level output to be more intense and smoothed",
+    )
+    parser.add_argument(
+        "--filter_sharpness", action=argparse.BooleanOptionalAction, default=True,
+        help="Filter the low level output to be more intense and smoothed",
+    )
+    parser.add_argument(
+        "--num_images_per_sample", type=int, default=16,
+        help="Number of images to generate and select between for final recon",
+    )
+    parser.add_argument(
+        "--retrieval", action=argparse.BooleanOptionalAction, default=True,
+    )
+    parser.add_argument(
+        "--prompt_recon", action=argparse.BooleanOptionalAction, default=True,
+        help="Use for prompt generation",
+    )
+    parser.add_argument(
+        "--caption_type", type=str, default='medium', choices=['coco', 'short', 'medium', 'schmedium'],
+    )
+    parser.add_argument(
+        "--compile_models", action=argparse.BooleanOptionalAction, default=True,
+        help="Use for speeding up stable cascade",
+    )
+    parser.add_argument(
+        "--num_trial_reps", type=int, default=16,
+        help="Number of trial repetitions to average test betas across",
+    )
+    parser.add_argument(
+        "--sampler_preset", type=str, default="balanced", choices=list(SAMPLER_PRESETS),
+        help="Stage C and Stage B step counts, shifts and guidance scales; strength still scales the Stage C steps",
+    )
+    parser.add_argument(
+        "--recon_batch_size", type=int, default=16,
+        help="Maximum number of images generated at once by Stable Cascade",
+    )
+    parser.add_argument(
+        "--queue_size", type=int, default=4,
+        help="Maximum number of batches waiting between pipeline stages",
+    )
+    parser.add_argument(
+        "--device", type=str, default="cuda",
+    )
+    parser.add_argument(
+        "--devices", type=str, nargs="+", default=None,
+        help="Generate on one worker process per listed device, e.g. cuda:0 cuda:1, instead of on --device",
+    )
+    parser.add_argument(
+        "--resume", action=argparse.BooleanOptionalAction, default=False,
+        help="Reuse saved predictions and only generate the batches missing from the stores of an interrupted run",
+    )
+    return parser.parse_args(argv)
+
+
+def load_data(args):
+    """Returns the test voxels and ground truth images of args.mode, like recon_inference_mi.ipynb."""
+    if args.mode == "shared1000":
+        import h5py
+        _, _, x_test, test_nsd_ids = utils.load_nsd(subject=args.subj, data_path=args.data_path)
+        voxels = torch.mean(x_test, dim=1, keepdim=True)
+        with h5py.File(f'{args.data_path}/coco_images_224_float16.hdf5', 'r') as f:
+            all_images = utils.gather_embedding_bank(f['images'], test_nsd_ids)
+    else:
+        voxels, all_images = utils.load_nsd_mental_imagery(subject=args.subj, mode=args.mode, stimtype="all", average=True,
+                                                           nest=False, num_reps=args.num_trial_reps, data_root=args.data_path)
+    return voxels, all_images
+
+
+def predict_heads(args, voxels):
+    """Predicts every enabled ridge head from one pass over the voxels."""
+    outdir = os.path.abspath(f'../train_logs/{args.model_name}')
+    heads = {"image": True, "text": args.dual_guidance, "prompt": args.prompt_recon, "blurry": args.blurry_recon, "retrieval": args.retrieval}
+    ridge_decoder = FusedRidgeDecoder({name: f'{outdir}/ridge_{name}_weights.safetensors' for name, enabled in heads.items() if enabled}, device=args.device)
+    preds = ridge_decoder.predict(voxels[:, 0], normalize=args.normalize_preds)
+    if args.retrieval and args.normalize_preds:
+        # L2 Normalize for optimal cosine similarity
+        preds["retrieval"] = torch.nn.functional.normalize(preds["retrieval"], p=2, dim=2)
+    return preds
+
+
+def caption_predictions(pred_git_text, device):
+    """Captions the predicted GIT embeddings in batches, returning an array of strings."""
+    from transformers import AutoProcessor
+    from modeling_git import GitForCausalLMClipEmb
+    processor = AutoProcessor.from_pretrained("microsoft/git-large-coco")
+    git_text_model = GitForCausalLMClipEmb.from_pretrained("microsoft/git-large-coco", torch_dtype=torch.float16)
+    git_text_model.to(device)
+    git_text_model.eval().requires_grad_(False)
+    generated_ids = git_text_model.generate_captions(pred_git_text, max_length=20)
+    return np.array(processor.batch_decode(generated_ids, skip_special_tokens=True))
+
+
+class PipelineStage(threading.Thread):
+    """Runs fn on every item taken from in_queue until a None sentinel.
+
+    Exceptions are kept in self.error, so the producing thread can stop instead of waiting on a full queue.
+    """
+    def __init__(self, fn, in_queue):
+        super().__init__(daemon=True)
+        self.fn = fn
+        self.in_queue = in_queue
+        self.error = None
+
+    def run(self):
+        try:
+            for item in iter(self.in_queue.get, None):
+                self.fn(item)
+        except BaseException as error:
+            self.error = error
+
+
+def put(out_queue, item, stages):
+    """Blocking put that gives up when a downstream stage has died."""
+    while True:
+        for stage in stages:
+            if stage.error is not None:
+                raise RuntimeError("Pipeline stage failed") from stage.error
+        try:
+            out_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def batch_seed(seed, rep, start):
+    """Seed of the batch of samples starting at start in rep, independent of the order batches are run in."""
+    return int(np.random.SeedSequence([seed, rep, start]).generate_state(1)[0])
+
+
+def load_models(args, device):
+    """Loads the Stable Cascade reconstructor and, with --blurry_recon, VDVAE on one device."""
+    from sc_reconstructor import SC_Reconstructor
+    # Compiled kernels are cached next to the model weights and reused by later runs
+    reconstructor = SC_Reconstructor(compile_models=args.compile_models, device=device, compile_cache_dir=f"{args.cache_dir}/torch_compile")
+    vdvae = None
+    if args.blurry_recon:
+        from vdvae import VDVAE
+        vdvae = VDVAE(device=device, cache_dir=args.cache_dir)
+    return reconstructor, vdvae
+
+
+def generate_batch(args, models, preds, rep, start, end, device, sampler=None):
+    """Generates the reconstructions of samples start to end in rep, seeded from the batch's position.
+
+    Args:
+        sampler (dict, optional): Sampler settings passed to SC_Reconstructor.reconstruct_batch.
+            Defaults to the settings of args.sampler_preset.
+
+    Returns:
+        tuple: (rep, start, end, seed, recons, blurred_images, candidates), where recons has shape
+            (end - start, reps, 3, H, W) and candidates holds every image the best ones were picked
+            from when they are saved with --save_raw.
+    """
+    reconstructor, vdvae = models
+    pick_best = args.num_images_per_sample > 1
+    # Every random draw of a batch happens here, in a fixed order after seeding, so a batch gives
+    # the same reconstructions whether it runs in a fresh, a resumed or a multi-device run
+    seed = batch_seed(args.seed, rep, start)
+    utils.seed_everything(seed)
+    blurred_images = None
+    if args.blurry_recon:
+        # VDVAE decoding and filtering on the GPU
+        blurred_images = vdvae.reconstruct_batch(preds["blurry"][start:end])
+        if args.filter_sharpness:
+            # This helps make the output not blurry when using the VDVAE
+            blurred_images = transforms.functional.adjust_sharpness(blurred_images, 20)
+        if args.filter_contrast:
+            # This boosts the structural impact of the blurred_image
+            blurred_images = transforms.functional.adjust_contrast(blurred_images, 1.5)
+    samples = reconstructor.reconstruct_batch(c_i=preds["image"][start:end],
+                                              c_t=preds["text"][start:end] if args.dual_guidance else None,
+                                              images=blurred_images,
+                                              n_samples=args.num_images_per_sample if pick_best else args.gen_rep,
+                                              max_batch_size=args.recon_batch_size,
+                                              textstrength=args.textstrength,
+                                              strength=args.strength,
+                                              output_device=device,
+                                              **(sampler or SAMPLER_PRESETS[args.sampler_preset]))
+    candidates = None
+    if pick_best:
+        reference = preds["retrieval"][start:end] if args.retrieval else preds["image"][start:end]
+        best_idx, _ = utils.pick_best_recons(samples, reference, reconstructor, hidden=args.retrieval)
+        candidates = samples if args.save_raw and rep == 0 else None
+        samples = samples[torch.arange(len(samples)), best_idx[:, 0].to(samples.device)].unsqueeze(1)
+    return rep, start, end, seed, samples, blurred_images, candidates
+
+
+def reconstruction_worker(args, device, preds, load_models, tasks, results, done):
+    """Worker process of run_workers, generating the batches it takes from tasks until a None sentinel."""
+    try:
+        if device.startswith("cuda"):
+            torch.cuda.set_device(device)
+        preds = {name: pred.to(device) for name, pred in preds.items()}
+        models = load_models(args, device)
+        for rep, start, end in iter(tasks.get, None):
+            item = generate_batch(args, models, preds, rep, start, end, device)
+            results.put(tuple(value.cpu() if torch.is_tensor(value) else value for value in item))
+    except BaseException:
+        results.put(RuntimeError(f"Worker on {device} failed:\n{traceback.format_exc()}"))
+    results.put(None)
+    # Tensors are sent through shared memory, so stay alive until the main process has received them
+    done.wait()
+
+
+def run_workers(args, devices, preds, batches, load_models=load_models):
+    """Generates batches on one worker process per device, yielding the generate_batch outputs as they finish.
+
+    Workers take the next batch from a shared queue whenever they finish one, so batches that take
+    longer, e.g. when picking the best of many candidates, or slower devices do not hold the others up.
+
+    Args:
+        devices (list): One device per worker, e.g. ["cuda:0", "cuda:1"] or ["cpu", "cpu"].
+        preds (dict): Predicted embeddings of every head, sent to each worker.
+        batches (list): (rep, start, end) of every batch to generate.
+        load_models (callable, optional): Picklable load_models(args, device) returning the
+            (reconstructor, vdvae) of a worker. Defaults to load_models.
+
+    Raises:
+        RuntimeError: If a worker fails or dies.
+    """
+    context = torch.multiprocessing.get_context("spawn")
+    tasks, results, done = context.Queue(), context.Queue(), context.Event()
+    for batch in batches:
+        tasks.put(batch)
+    for _ in devices:
+        tasks.put(None)
+    preds = {name: pred.cpu() for name, pred in preds.items()}
+    workers = [context.Process(target=reconstruction_worker, args=(args, device, preds, load_models, tasks, results, done), daemon=True)
+               for device in devices]
+    for worker in workers:
+        worker.start()
+    try:
+        running = len(workers)
+        while running:
+            try:
+                item = results.get(timeout=1)
+            except queue.Empty:
+                if any(worker.exitcode not in (None, 0) for worker in workers):
+                    raise RuntimeError(f"Worker processes exited with {[worker.exitcode for worker in workers]}")
+                continue
+            if item is None:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        done.set()
+        for worker in workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+
+def reconstruct(args, load_models=load_models):
+    device = args.device
+    if not args.blurry_recon:
+        args.strength = 1.0
+    if not args.retrieval:
+        args.num_images_per_sample = 1
+    os.makedirs(f"evals/{args.model_name}", exist_ok=True)
+    settings = {key: value for key, value in vars(args).items() if key not in RUNTIME_ARGS}
+
+    voxels, all_images = load_data(args)
+    num_test = len(voxels)
+    print(f"{args.mode}: {tuple(voxels.shape)}")
+    # Predictions are saved for resuming, so an interrupted run does not recompute them
+    preds_path = f"evals/{args.model_name}/{args.model_name}_preds_{args.mode}.pt"
+    captions_path = f"evals/{args.model_name}/{args.model_name}_all_predcaptions_{args.mode}.pt"
+    if args.resume and os.path.exists(preds_path):
+        preds = {name: pred.to(device) for name, pred in torch.load(preds_path).items()}
+    else:
+        preds = predict_heads(args, voxels)
+        torch.save({name: pred.cpu() for name, pred in preds.items()}, preds_path)
+    if args.prompt_recon:
+        if args.resume and os.path.exists(captions_path):
+            all_predcaptions = torch.load(captions_path)
+        else:
+            all_predcaptions = caption_predictions(preds["prompt"], device)
+            torch.save(all_predcaptions, captions_path)
+
+    # With several images per sample, every rep redraws the low-level images and keeps the best candidate;
+    # otherwise all gen_rep reconstructions share one draw of the low-level images
+    pick_best = args.num_images_per_sample > 1
+    num_reps = args.gen_rep if pick_best else 1
+    num_candidates = args.num_images_per_sample if pick_best else args.gen_rep
+    samples_per_batch = max(1, args.recon_batch_size // num_candidates)
+    batches = [(rep, start, min(start + samples_per_batch, num_test)) for rep in range(num_reps) for start in range(0, num_test, samples_per_batch)]
+
+    # Reconstructions are appended to on-disk stores as they finish, and exported to the .pt files at the end
+    recon_path = f"evals/{args.model_name}/{args.model_name}_all_recons_{args.mode}"
+    blurry_path = f"evals/{args.model_name}/{args.model_name}_all_blurryrecons_{args.mode}"
+    stores = {}
+    stored = {"recons": set(), "blurry": set()}
+    for name, path in (("recons", recon_path), ("blurry", blurry_path)):
+        if args.resume and os.path.exists(f"{path}.store"):
+            stores[name] = utils.open_recon_store(f"{path}.store", settings=settings)
+            stored[name] = {(entry["sample"], entry["rep"]) for entry in utils.recon_store_index(f"{path}.store")[1]}
+
+    def is_stored(rep, start, end):
+        samples = range(start, end)
+        reps = range(rep, rep + 1) if pick_best else range(args.gen_rep)
+        recons_stored = all((sample, r) in stored["recons"] for sample in samples for r in reps)
+        return recons_stored and (not args.blurry_recon or all((sample, rep) in stored["blurry"] for sample in samples))
+
+    pending = [batch for batch in batches if not is_stored(*batch)]
+    if len(pending) < len(batches):
+        print(f"Resuming, {len(batches) - len(pending)} of {len(batches)} batches are already stored")
+
+    raw_root = None
+    if args.save_raw:
+        raw_root = f"{args.raw_path}/{args.mode}/{args.model_name}/subject{args.subj}/"
+        os.makedirs(raw_root, exist_ok=True)
+        torch.save(preds["image"], f"{raw_root}/stable_cascade_image_voxels.pt")
+        if args.dual_guidance:
+            text_embedding_variant = "stable_cascade" + (f"_{args.caption_type}" if args.caption_type != "coco" else "")
+            torch.save(preds["text"], f"{raw_root}/{text_embedding_variant}_text_voxels.pt")
+        if args.blurry_recon:
+            torch.save(preds["blurry"], f"{raw_root}/vdvae_latent_voxels.pt")
+        if args.retrieval:
+            torch.save(preds["retrieval"], f"{raw_root}/stable_cascade_hidden_retrieval_voxels.pt")
+
+    def write_batch(item):
+        rep, start, end, seed, recons, blurred_images, candidates = item
+        recons = recons.cpu()
+        if "recons" not in stores:
+            stores["recons"] = utils.create_recon_store(f"{recon_path}.store", (num_test, args.gen_rep) + recons.shape[2:], settings=settings)
+        utils.append_recon_store(f"{recon_path}.store", stores["recons"], range(start, end), range(rep, rep + recons.shape[1]), recons,
+                                 seeds=np.full(recons.shape[:2], seed))
+        if blurred_images is not None:
+            blurred_images = blurred_images.cpu()
+            if "blurry" not in stores:
+                stores["blurry"] = utils.create_recon_store(f"{blurry_path}.store", (num_test, num_reps) + blurred_images.shape[1:], settings=settings)
+            utils.append_recon_store(f"{blurry_path}.store", stores["blurry"], range(start, end), [rep], blurred_images.unsqueeze(1),
+                                     seeds=np.full((len(blurred_images), 1), seed))
+        if raw_root is None:
+            return
+        for i, idx in enumerate(range(start, end)):
+            os.makedirs(f"{raw_root}/{idx}/", exist_ok=True)
+            for r in range(recons.shape[1]):
+                transforms.ToPILImage()(recons[i, r]).save(f"{raw_root}/{idx}/{rep + r}.png")
+            if rep > 0:
+                continue
+            if candidates is not None:
+                os.makedirs(f"{raw_root}/{idx}/retrieval_images/", exist_ok=True)
+                for r_idx, image in enumerate(candidates[i].cpu()):
+                    transforms.ToPILImage()(image).save(f"{raw_root}/{idx}/retrieval_images/{r_idx}.png")
+            transforms.ToPILImage()(all_images[idx]).save(f"{raw_root}/{idx}/ground_truth.png")
+            if blurred_images is not None:
+                transforms.ToPILImage()(blurred_images[i]).save(f"{raw_root}/{idx}/low_level.png")
+            torch.save(preds["image"][idx].clone(), f"{raw_root}/{idx}/clip_image_voxels.pt")
+            if args.dual_guidance:
+                torch.save(preds["text"][idx].clone(), f"{raw_root}/{idx}/clip_text_voxels.pt")
+            if args.prompt_recon:
+                with open(f"{raw_root}/{idx}/predicted_caption.txt", "w") as f:
+                    f.write(all_predcaptions[idx])
+
+    if pending:
+        if args.devices:
+            items = run_workers(args, args.devices, preds, pending, load_models=load_models)
+        else:
+            models = load_models(args, device)
+            items = (generate_batch(args, models, preds, rep, start, end, device) for rep, start, end in pending)
+        write_queue = queue.Queue(maxsize=args.queue_size)
+        writer = PipelineStage(write_batch, write_queue)
+        writer.start()
+        try:
+            for item in tqdm(items, total=len(pending), desc="sample loop"):
+                put(write_queue, item, [writer])
+        finally:
+            items.close()
+            put(write_queue, None, [writer])
+            writer.join()
+        if writer.error is not None:
+            raise RuntimeError("Pipeline stage failed") from writer.error
+
+    if args.blurry_recon:
+        # Low-level images are stacked along the channel dimension, one column per rep, as in recon_inference_mi.ipynb
+        final_blurryrecons = utils.load_recon_store(f"{blurry_path}.store").transpose(1, 2).flatten(0, 1)
+        if not pick_best:
+            final_blurryrecons = final_blurryrecons[:, 0]
+        torch.save(final_blurryrecons, f"{blurry_path}.pt")
+    final_recons = utils.load_recon_store(f"{recon_path}.store")
+    torch.save(final_recons, f"{recon_path}.pt")
+    print(f"saved {args.model_name} mi outputs!")
+    return final_recons
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f"args: {args}")
+    reconstruct(args)
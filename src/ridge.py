@@ -0,0 +1,466 @@
+import os
+import json
+import pickle
+import contextlib
+import numpy as np
+import torch
+from tqdm import tqdm
+from safetensors.numpy import save_file
+
+
+@contextlib.contextmanager
+def full_precision_matmul():
+    # Train.ipynb enables TF32 globally, which is too lossy for Gram matrices and their eigendecomposition
+    previous = torch.backends.cuda.matmul.allow_tf32
+    torch.backends.cuda.matmul.allow_tf32 = False
+    try:
+        yield
+    finally:
+        torch.backends.cuda.matmul.allow_tf32 = previous
+
+
+class RidgeSolver(object):
+    """Closed-form ridge regression that shares one decomposition of X across every target and alpha.
+
+    Fitting the image, text, VDVAE, GIT and retrieval heads with separate sklearn Ridge models
+    refactorizes the same voxel matrix each time. This solver centers X once and eigendecomposes
+    either X^T X (n >= p, primal form) or the Gram matrix X X^T (n < p, dual form). Any target
+    block can then be solved for any alpha with a few matrix products. Targets are streamed in
+    column blocks, so large heads like the 91168-dim VDVAE latent or the 257x1024 GIT features are
+    never materialized as one float64 matrix. The solution matches sklearn.linear_model.Ridge.
+
+    Args:
+        x (torch.Tensor or np.ndarray): Training voxels of shape (n, p).
+        fit_intercept (bool, optional): Whether to center X and the targets. Defaults to True.
+        device (str, optional): Device the decomposition and solves run on. Defaults to "cpu".
+        dtype (torch.dtype, optional): Compute dtype. Defaults to torch.float32.
+    """
+    def __init__(self, x, fit_intercept=True, device="cpu", dtype=torch.float32):
+        self.device = device
+        self.dtype = dtype
+        self.fit_intercept = fit_intercept
+        x = torch.as_tensor(x).to(device, dtype)
+        self.n, self.p = x.shape
+        if fit_intercept:
+            self.x_mean = x.mean(dim=0)
+            x = x - self.x_mean
+        else:
+            self.x_mean = torch.zeros(self.p, device=device, dtype=dtype)
+        self.x = x
+        self.dual = self.n < self.p
+        with full_precision_matmul():
+            # Eigenvalues of the smaller of X X^T and X^T X are the squared singular values of X
+            gram = x @ x.T if self.dual else x.T @ x
+            eigvals, self.eigvecs = torch.linalg.eigh(gram)
+            del gram
+        self.eigvals = eigvals.clamp(min=0)
+        self.z = None
+
+    def hat_factor(self):
+        """Returns Z with X (X^T X + alpha I)^-1 X^T = Z diag(1 / (eigvals + alpha)) Z^T for every alpha."""
+        if self.z is None:
+            with full_precision_matmul():
+                self.z = self.eigvecs * self.eigvals.sqrt() if self.dual else self.x @ self.eigvecs
+        return self.z
+
+    def project(self, y):
+        """Projects a centered target block onto the eigenbasis, the part of a solve shared by all alphas."""
+        if self.dual:
+            return self.eigvecs.T @ y
+        return self.eigvecs.T @ (self.x.T @ y)
+
+    def solve_projected(self, projected, alpha):
+        """Finishes a solve for one alpha from project(); returns coefficients of shape (p, targets)."""
+        scaled = projected / (self.eigvals + alpha).unsqueeze(1)
+        if self.dual:
+            return self.x.T @ (self.eigvecs @ scaled)
+        return self.eigvecs @ scaled
+
+    def solve(self, y, alpha, block_size=8192):
+        """Solves ridge regression for every column of y and one or several alphas.
+
+        Args:
+            y (torch.Tensor or np.ndarray): Targets of shape (n, targets). Only block_size columns
+                are moved to the compute device and converted at a time.
+            alpha (float or list): Regularization strength, or a list of them.
+            block_size (int, optional): Number of target columns solved per block. Defaults to 8192.
+
+        Returns:
+            tuple or list: (coef, intercept) as float32 numpy arrays of shape (targets, p) and
+            (targets,), laid out like sklearn's coef_ and intercept_. A list of such tuples,
+            one per alpha, when alpha is a list.
+        """
+        alphas = list(alpha) if isinstance(alpha, (list, tuple, np.ndarray)) else [alpha]
+        y = torch.as_tensor(y)
+        y = y.reshape(len(y), -1)
+        num_targets = y.shape[1]
+        coefs = [np.zeros((num_targets, self.p), dtype=np.float32) for _ in alphas]
+        intercepts = [np.zeros(num_targets, dtype=np.float32) for _ in alphas]
+        with torch.no_grad(), full_precision_matmul():
+            for start in tqdm(range(0, num_targets, block_size), desc="Solving ridge target blocks", disable=num_targets <= block_size):
+                y_block = y[:, start:start + block_size].to(self.device, self.dtype)
+                y_mean = y_block.mean(dim=0) if self.fit_intercept else torch.zeros(y_block.shape[1], device=self.device, dtype=self.dtype)
+                projected = self.project(y_block - y_mean)
+                del y_block
+                for coef, intercept, a in zip(coefs, intercepts, alphas):
+                    w = self.solve_projected(projected, a)
+                    coef[start:start + block_size] = w.T.float().cpu().numpy()
+                    intercept[start:start + block_size] = (y_mean - self.x_mean @ w).float().cpu().numpy()
+        results = list(zip(coefs, intercepts))
+        return results if isinstance(alpha, (list, tuple, np.ndarray)) else results[0]
+
+    def group_batches(self, groups, max_rows=8192):
+        """Splits rows into batches of equally sized groups, as (num_groups, group_size) index tensors."""
+        groups = np.asarray(groups)
+        order = np.argsort(groups, kind="stable")
+        _, starts, sizes = np.unique(groups[order], return_index=True, return_counts=True)
+        batches = []
+        for size in np.unique(sizes):
+            idx = np.stack([order[start:start + size] for start in starts[sizes == size]])
+            per_batch = max(1, max_rows // size)
+            for i in range(0, len(idx), per_batch):
+                batches.append(torch.from_numpy(idx[i:i + per_batch]).to(self.device))
+        return batches
+
+    def group_inverses(self, batches, alpha):
+        """Computes (I - H_gg)^-1 for every held-out group g, where H is the ridge hat matrix with intercept."""
+        z = self.hat_factor()
+        scale = 1 / (self.eigvals + alpha)
+        inverses = []
+        for idx in batches:
+            z_g = z[idx]
+            h_gg = (z_g * scale) @ z_g.transpose(1, 2)
+            if self.fit_intercept:
+                h_gg = h_gg + 1 / self.n
+            eye = torch.eye(idx.shape[1], device=self.device, dtype=self.dtype)
+            inverses.append(torch.linalg.inv(eye - h_gg))
+        return inverses
+
+    def solve_cv(self, y, alphas, groups, per_target=True, block_size=8192):
+        """Solves ridge regression, picking alpha from a grid by leave-group-out cross-validation.
+
+        Held-out errors for every alpha come from the shared decomposition in closed form: for each
+        group g of rows, e_g = (I - H_gg)^-1 (y_g - yhat_g), with H the hat matrix of the fit on
+        all rows. Group the rows by NSD image ID so that repeats of an image are always held out
+        together and never leak between the training and validation side.
+
+        Args:
+            y (torch.Tensor or np.ndarray): Targets of shape (n, targets).
+            alphas (list): Grid of regularization strengths to select from.
+            groups (np.ndarray): Group label for every row of x, e.g. the NSD image IDs.
+            per_target (bool, optional): Select an alpha per target column. If False, one alpha
+                is selected for all of y by the mean error across targets. Defaults to True.
+            block_size (int, optional): Number of target columns solved per block. Defaults to 8192.
+
+        Returns:
+            tuple: (coef, intercept, best_alphas) where best_alphas has shape (targets,).
+        """
+        alphas = list(alphas)
+        y = torch.as_tensor(y)
+        y = y.reshape(len(y), -1)
+        num_targets = y.shape[1]
+        batches = self.group_batches(groups)
+        z = self.hat_factor()
+        coef = np.zeros((num_targets, self.p), dtype=np.float32)
+        intercept = np.zeros(num_targets, dtype=np.float32)
+        errors = np.zeros((len(alphas), num_targets), dtype=np.float64)
+        with torch.no_grad(), full_precision_matmul():
+            inverses = [self.group_inverses(batches, a) for a in alphas]
+            for start in tqdm(range(0, num_targets, block_size), desc="Cross-validating ridge target blocks", disable=num_targets <= block_size):
+                y_block = y[:, start:start + block_size].to(self.device, self.dtype)
+                y_mean = y_block.mean(dim=0) if self.fit_intercept else torch.zeros(y_block.shape[1], device=self.device, dtype=self.dtype)
+                y_block = y_block - y_mean
+                projected = self.project(y_block)
+                z_y = projected * self.eigvals.sqrt().unsqueeze(1) if self.dual else projected
+                best_error, best_w = None, None
+                for i, a in enumerate(alphas):
+                    residuals = y_block - z @ (z_y / (self.eigvals + a).unsqueeze(1))
+                    sq_error = torch.zeros(y_block.shape[1], device=self.device, dtype=torch.float64)
+                    for idx, inverse in zip(batches, inverses[i]):
+                        sq_error += (inverse @ residuals[idx]).double().pow(2).sum(dim=(0, 1))
+                    errors[i, start:start + block_size] = (sq_error / self.n).cpu().numpy()
+                    if per_target:
+                        w = self.solve_projected(projected, a)
+                        improved = torch.from_numpy(errors[i, start:start + block_size] <= errors[:i + 1, start:start + block_size].min(axis=0)).to(self.device)
+                        best_w = w if best_w is None else torch.where(improved, w, best_w)
+                if per_target:
+                    coef[start:start + block_size] = best_w.T.float().cpu().numpy()
+                    intercept[start:start + block_size] = (y_mean - self.x_mean @ best_w).float().cpu().numpy()
+        if per_target:
+            best_alphas = np.asarray(alphas)[errors.argmin(axis=0)]
+        else:
+            best_alphas = np.full(num_targets, alphas[errors.mean(axis=1).argmin()])
+            coef, intercept = self.solve(y, best_alphas[0], block_size=block_size)
+        return coef, intercept, best_alphas
+
+    def reduce_rank(self, coef, intercept, rank, block_size=8192):
+        """Reduced-rank ridge: projects fitted coefficients onto the top principal components of their training predictions.
+
+        With X = U S V^T and fitted training predictions Y_hat = X W^T, the right singular vectors
+        of Y_hat are the left singular vectors of B = W V S, which only needs the (r, r) matrix
+        B^T B with r = min(n, p). The projected coefficients P P^T W, with P the top rank singular
+        vectors, are returned as two factors so the full (targets, p) matrix never has to be stored.
+
+        Args:
+            coef (np.ndarray): Coefficients of shape (targets, p) from solve() or solve_cv().
+            intercept (np.ndarray): Intercepts of shape (targets,).
+            rank (int): Number of target components to keep.
+            block_size (int, optional): Number of target rows processed per block. Defaults to 8192.
+
+        Returns:
+            tuple: (u, v, intercept) as float32 numpy arrays of shape (targets, rank), (rank, p) and
+            (targets,), with the reduced-rank coefficients equal to u @ v.
+        """
+        num_targets = len(coef)
+        u = np.zeros((num_targets, rank), dtype=np.float32)
+        v = torch.zeros((rank, self.p), device=self.device, dtype=torch.float64)
+        reduced_intercept = np.zeros(num_targets, dtype=np.float32)
+        with torch.no_grad(), full_precision_matmul():
+            # V S, the right singular vectors of centered X scaled by its singular values
+            vs = self.x.T @ self.eigvecs if self.dual else self.eigvecs * self.eigvals.sqrt()
+            gram = torch.zeros((vs.shape[1], vs.shape[1]), device=self.device, dtype=torch.float64)
+            for start in range(0, num_targets, block_size):
+                b = torch.as_tensor(coef[start:start + block_size]).to(self.device, self.dtype) @ vs
+                gram += (b.T @ b).double()
+            eigvals, eigvecs = torch.linalg.eigh(gram)
+            top = eigvecs[:, -rank:].flip(1) / eigvals[-rank:].flip(0).clamp(min=1e-12).sqrt()
+            top = top.to(self.dtype)
+            for start in tqdm(range(0, num_targets, block_size), desc="Reducing ridge rank", disable=num_targets <= block_size):
+                w = torch.as_tensor(coef[start:start + block_size]).to(self.device, self.dtype)
+                u_block = (w @ vs) @ top
+                v += (u_block.T @ w).double()
+                u[start:start + block_size] = u_block.float().cpu().numpy()
+                # Recover the training target means from the full-rank intercepts
+                reduced_intercept[start:start + block_size] = (torch.as_tensor(intercept[start:start + block_size]).to(self.device, self.dtype) + w @ self.x_mean).float().cpu().numpy()
+            v = v.to(self.dtype)
+            u_t = torch.from_numpy(u).to(self.device, self.dtype)
+            reduced_intercept -= (u_t @ (v @ self.x_mean)).float().cpu().numpy()
+        return u, v.float().cpu().numpy(), reduced_intercept
+
+
+# safetensors dtype tags and the numpy dtype their bytes are memory-mapped as
+SAFETENSORS_DTYPES = {"F64": np.float64, "F32": np.float32, "F16": np.float16, "BF16": np.uint16}
+
+
+def save_ridge_weights(path, coef, intercept, variant, target_shape, target_mean=None, target_std=None, alpha=None, input_norm="none"):
+    """Saves a ridge head as a safetensors file that RidgeDecoder can memory-map.
+
+    Args:
+        path (str): Output path, conventionally {outdir}/ridge_{head}_weights.safetensors.
+        coef (np.ndarray or tuple): Coefficients of shape (targets, voxels), as returned by RidgeSolver,
+            or the (u, v) factors of a reduced-rank head from RidgeSolver.reduce_rank().
+        intercept (np.ndarray): Intercepts of shape (targets,).
+        variant (str): Name of the embedding variant the head predicts, e.g. "stable_cascade".
+        target_shape (tuple): Shape of one prediction, e.g. (257, 1024); its product must equal targets.
+        target_mean (torch.Tensor or np.ndarray, optional): Mean of the training targets over samples,
+            used to rescale predictions when normalize_preds is set. Defaults to None.
+        target_std (torch.Tensor or np.ndarray, optional): Standard deviation of the training targets
+            over samples. Defaults to None.
+        alpha (float or np.ndarray, optional): Regularization strength(s) the head was fit with. Defaults to None.
+        input_norm (str, optional): "l2" if the head was fit on L2-normalized voxels, else "none". Defaults to "none".
+    """
+    if isinstance(coef, tuple):
+        tensors = {"coef_u": np.ascontiguousarray(coef[0], dtype=np.float32), "coef_v": np.ascontiguousarray(coef[1], dtype=np.float32)}
+        num_targets, num_voxels = len(coef[0]), coef[1].shape[1]
+    else:
+        tensors = {"coef": np.ascontiguousarray(coef, dtype=np.float32)}
+        num_targets, num_voxels = coef.shape
+    assert num_targets == int(np.prod(target_shape)), f"coef has {num_targets} targets, expected {target_shape}"
+    tensors["intercept"] = np.ascontiguousarray(intercept, dtype=np.float32).reshape(-1)
+    if target_mean is not None:
+        tensors["target_mean"] = np.ascontiguousarray(torch.as_tensor(target_mean).float().numpy().reshape(-1))
+        tensors["target_std"] = np.ascontiguousarray(torch.as_tensor(target_std).float().numpy().reshape(-1))
+    if alpha is not None:
+        tensors["alpha"] = np.ascontiguousarray(alpha, dtype=np.float32).reshape(-1)
+    metadata = {
+        "variant": variant,
+        "target_shape": json.dumps([int(d) for d in target_shape]),
+        "num_voxels": str(num_voxels),
+        "input_norm": input_norm,
+    }
+    save_file(tensors, path + ".tmp", metadata=metadata)
+    os.replace(path + ".tmp", path)
+
+
+def convert_ridge_pickle(pickle_path, path, variant, target_shape, **kwargs):
+    """Converts a legacy ridge_{head}_weights.pkl datadict to the safetensors checkpoint format."""
+    with open(pickle_path, "rb") as f:
+        datadict = pickle.load(f)
+    kwargs.setdefault("alpha", datadict.get("alpha"))
+    save_ridge_weights(path, datadict["coef"], datadict["intercept"], variant, target_shape, **kwargs)
+
+
+def load_ridge_weights(path):
+    """Memory-maps every tensor of a ridge safetensors checkpoint without reading the data.
+
+    Returns:
+        tuple: (tensors, metadata) where tensors maps names to CPU torch.Tensors backed by the file.
+    """
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", {})
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        shape = tuple(info["shape"])
+        if begin == end:
+            array = np.zeros(shape, dtype=SAFETENSORS_DTYPES[info["dtype"]])
+        else:
+            # Copy-on-write, so torch can wrap the mapping without a read-only warning
+            array = np.memmap(path, dtype=SAFETENSORS_DTYPES[info["dtype"]], mode="c", offset=8 + header_size + begin, shape=shape)
+        tensor = torch.from_numpy(array)
+        tensors[name] = tensor.view(torch.bfloat16) if info["dtype"] == "BF16" else tensor
+    return tensors, metadata
+
+
+class RidgeDecoder(object):
+    """Predicts one embedding from voxels with a memory-mapped ridge checkpoint.
+
+    Replaces unpickling the weights into a dummy sklearn Ridge. Opening a checkpoint only reads
+    its header; coefficients are streamed from the mapping to the device in target blocks and
+    applied as a torch matmul, so the multi-GB VDVAE and GIT heads never have to be fully read
+    into host memory before predicting. Reduced-rank heads are applied as two matmuls through
+    their (targets, rank) and (rank, voxels) factors.
+
+    Args:
+        path (str): Checkpoint written by save_ridge_weights.
+        device (str, optional): Device predictions run on. Defaults to "cpu".
+        dtype (torch.dtype, optional): Matmul dtype. Defaults to torch.bfloat16 on CUDA, whose
+            range covers the small coefficients of heavily regularized heads, and torch.float32
+            otherwise. torch.float16 also works.
+    """
+    def __init__(self, path, device="cpu", dtype=None):
+        self.path = path
+        self.device = device
+        if dtype is None:
+            dtype = torch.bfloat16 if str(device).startswith("cuda") else torch.float32
+        self.dtype = dtype
+        self.tensors, self.metadata = load_ridge_weights(path)
+        self.intercept = self.tensors["intercept"]
+        if "coef_v" in self.tensors:
+            self.coef = None
+            self.coef_u = self.tensors["coef_u"]
+            self.coef_v = self.tensors["coef_v"].to(device, self.dtype)
+            self.rank = len(self.coef_v)
+        else:
+            self.coef = self.tensors["coef"]
+            self.rank = None
+        self.variant = self.metadata.get("variant")
+        self.target_shape = tuple(json.loads(self.metadata["target_shape"]))
+        self.input_norm = self.metadata.get("input_norm", "none")
+        self.num_targets = len(self.intercept)
+        self.num_voxels = int(self.metadata["num_voxels"])
+
+    @property
+    def has_normalization(self):
+        return "target_mean" in self.tensors
+
+    def prepare_voxels(self, voxels):
+        """Flattens voxels to (n, voxels) and applies the input normalization the head was fit with."""
+        voxels = torch.as_tensor(voxels).reshape(-1, self.num_voxels).to(self.device, torch.float32)
+        if self.input_norm == "l2":
+            voxels = torch.nn.functional.normalize(voxels, p=2, dim=1)
+        return voxels.to(self.dtype)
+
+    def predict(self, voxels, normalize=False, block_size=16384):
+        """Predicts embeddings for a batch of voxels.
+
+        Args:
+            voxels (torch.Tensor or np.ndarray): Voxels of shape (n, voxels).
+            normalize (bool, optional): Rescale the predictions to the training target statistics,
+                see normalize(). Defaults to False.
+            block_size (int, optional): Number of targets moved to the device per matmul. Defaults to 16384.
+
+        Returns:
+            torch.Tensor: float32 predictions of shape (n, *target_shape) on the CPU.
+        """
+        pred = self.predict_prepared(self.prepare_voxels(voxels), block_size=block_size)
+        return self.normalize(pred) if normalize else pred
+
+    def predict_prepared(self, voxels, block_size=16384):
+        """Predicts from the output of prepare_voxels(), streaming coefficient blocks to the device."""
+        pred = torch.zeros((len(voxels), self.num_targets), dtype=torch.float32)
+        with torch.no_grad():
+            if self.rank is not None:
+                voxels = voxels @ self.coef_v.T
+            for start in range(0, self.num_targets, block_size):
+                coef = (self.coef if self.rank is None else self.coef_u)[start:start + block_size].to(self.device, self.dtype, non_blocking=True)
+                intercept = self.intercept[start:start + block_size].to(self.device, torch.float32)
+                pred[:, start:start + block_size] = ((voxels @ coef.T).float() + intercept).cpu()
+        return pred.reshape(-1, *self.target_shape)
+
+    def normalize(self, pred):
+        """Standardizes predictions across samples, then rescales them to the training target mean and std."""
+        assert self.has_normalization, f"{self.path} has no target statistics, save it with target_mean and target_std"
+        std_pred = (pred - torch.mean(pred, axis=0)) / (torch.std(pred, axis=0) + 1e-6)
+        target_std = self.tensors["target_std"].reshape(self.target_shape)
+        target_mean = self.tensors["target_mean"].reshape(self.target_shape)
+        return std_pred * target_std + target_mean
+
+
+class FusedRidgeDecoder(object):
+    """Predicts every ridge head from one pass over a batch of voxels.
+
+    The voxels are moved to the device and normalized once per input normalization, then shared by
+    all heads instead of each head re-reading them. With resident=True, the coefficient matrices of
+    heads sharing an input normalization are concatenated on the device at construction, so each
+    predict() is a single matmul per group; this suits repeated calls on a GPU with enough memory.
+    Reduced-rank heads are small already and always run through their own factors.
+    Otherwise coefficients stay memory-mapped and are streamed in blocks as in RidgeDecoder.
+
+    Args:
+        paths (dict): Maps head names, e.g. "image" or "blurry", to checkpoints from save_ridge_weights.
+        device (str, optional): Device predictions run on. Defaults to "cpu".
+        dtype (torch.dtype, optional): Matmul dtype, see RidgeDecoder. Defaults to None.
+        resident (bool, optional): Keep concatenated coefficients on the device. Defaults to False.
+    """
+    def __init__(self, paths, device="cpu", dtype=None, resident=False):
+        self.device = device
+        self.decoders = {name: RidgeDecoder(path, device=device, dtype=dtype) for name, path in paths.items()}
+        self.resident = resident
+        self.groups = {}
+        for name, decoder in self.decoders.items():
+            self.groups.setdefault(decoder.input_norm, []).append(name)
+        if resident:
+            self.coefs, self.intercepts = {}, {}
+            with torch.no_grad():
+                for input_norm, names in self.groups.items():
+                    full = [name for name in names if self.decoders[name].rank is None]
+                    if full:
+                        self.coefs[input_norm] = torch.cat([self.decoders[name].coef.to(device, self.decoders[name].dtype) for name in full])
+                        self.intercepts[input_norm] = torch.cat([self.decoders[name].intercept.to(device, torch.float32) for name in full])
+
+    def __getitem__(self, name):
+        return self.decoders[name]
+
+    def predict(self, voxels, normalize=False, block_size=16384):
+        """Predicts all heads for a batch of voxels.
+
+        Args:
+            voxels (torch.Tensor or np.ndarray): Voxels of shape (n, voxels).
+            normalize (bool, optional): Rescale each head to its training target statistics. Defaults to False.
+            block_size (int, optional): Targets streamed per matmul when not resident. Defaults to 16384.
+
+        Returns:
+            dict: Maps each head name to float32 predictions of shape (n, *target_shape) on the CPU.
+        """
+        voxels = torch.as_tensor(voxels)
+        voxels = voxels.reshape(len(voxels), -1).to(self.device, torch.float32)
+        preds = {}
+        with torch.no_grad():
+            for input_norm, names in self.groups.items():
+                prepared = self.decoders[names[0]].prepare_voxels(voxels)
+                streamed = names
+                if self.resident and input_norm in self.coefs:
+                    full = [name for name in names if self.decoders[name].rank is None]
+                    streamed = [name for name in names if name not in full]
+                    fused = ((prepared @ self.coefs[input_norm].T).float() + self.intercepts[input_norm]).cpu()
+                    sizes = [self.decoders[name].num_targets for name in full]
+                    for name, pred in zip(full, fused.split(sizes, dim=1)):
+                        preds[name] = pred.reshape(-1, *self.decoders[name].target_shape)
+                for name in streamed:
+                    preds[name] = self.decoders[name].predict_prepared(prepared, block_size=block_size)
+        if normalize:
+            preds = {name: self.decoders[name].normalize(pred) for name, pred in preds.items()}
+        return preds
@@ -12,12 +12,40 @@ from inference.utils import *
 from train import WurstCoreC, WurstCoreB
 
 
+def enable_compile_cache(cache_dir):
+    """Keeps the Inductor and Triton caches of torch.compile in cache_dir instead of /tmp, so later
+    processes reuse the compiled and autotuned kernels instead of compiling them again.
+
+    Inductor has no config option for its cache directory; it reads TORCHINDUCTOR_CACHE_DIR when it
+    first needs the directory, and torch 2.1 keeps that first value for the rest of the process while
+    newer versions write their default back to the variable. The variables are therefore overwritten
+    rather than set if missing, and a directory Inductor already cached, e.g. from an earlier compiled
+    call, is dropped so the next one picks up cache_dir. Compiled calls made before this still wrote
+    their kernels to the old directory.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = f"{cache_dir}/inductor"
+    os.environ["TRITON_CACHE_DIR"] = f"{cache_dir}/triton"
+    import torch._inductor.config as inductor_config
+    from torch._inductor import codecache
+    if hasattr(codecache.cache_dir, "cache_clear"):
+        codecache.cache_dir.cache_clear()
+    if hasattr(inductor_config, "fx_graph_cache"):
+        # torch >= 2.2 can also cache the compiled graphs, skipping Inductor's lowering
+        inductor_config.fx_graph_cache = True
+
+
 class SC_Reconstructor(object):
-    def __init__(self, device="cuda:0", cache_dir="../cache/", embedder_only=False, compile_models=False):
+    def __init__(self, device="cuda:0", cache_dir="../cache/", embedder_only=False, compile_models=False,
+                 batch_buckets=(1, 2, 4, 8, 16, 32, 64), compile_cache_dir=None):
         print(f"Stable Cascade Reconstructor: Loading model...")
         self.device = device
         self.cache_dir = cache_dir
         self.dtype = torch.bfloat16
+        # Compiled generators are specialized to their batch size, so they are only run on these sizes
+        self.batch_buckets = tuple(sorted(batch_buckets)) if compile_models else None
+        if compile_models:
+            enable_compile_cache(compile_cache_dir or f"{cache_dir}/torch_compile")
         # SETUP STAGE C
         config_c = {
                 "model_version": "3.6B",
@@ -34,7 +62,7 @@ class SC_Reconstructor(object):
         self.models.generator.eval().requires_grad_(False)
         if compile_models:
             self.models = WurstCoreC.Models(
-            **{**self.models.to_dict(), 'generator': torch.compile(self.models.generator, mode="reduce-overhead", fullgraph=True)}
+            **{**self.models.to_dict(), 'generator': torch.compile(self.models.generator, mode="reduce-overhead", fullgraph=True, dynamic=False)}
             )
         print("STAGE C READY")
         
@@ -61,15 +89,45 @@ class SC_Reconstructor(object):
             self.models_b.generator.bfloat16().eval().requires_grad_(False)
             if compile_models:
                 self.models_b = WurstCoreB.Models(
-                **{**self.models_b.to_dict(), 'generator': torch.compile(self.models_b.generator, mode="reduce-overhead", fullgraph=True)}
+                **{**self.models_b.to_dict(), 'generator': torch.compile(self.models_b.generator, mode="reduce-overhead", fullgraph=True, dynamic=False)}
                 )
+
+            # Empty-prompt conditionings are the same on every call, so encode them once and expand them per batch
+            batch = {'captions': [""]}
+            with torch.no_grad():
+                self.conditions_b = self.core_b.get_conditions(batch, self.models_b, self.extras_b, is_eval=True, is_unconditional=False)
+                self.unconditions = self.core.get_conditions(batch, self.models, self.extras, is_eval=True, is_unconditional=True, eval_image_embeds=False)
+                self.unconditions_b = self.core_b.get_conditions(batch, self.models_b, self.extras_b, is_eval=True, is_unconditional=True)
             print("STAGE B READY")
     
-    def embed_image(self, images, hidden=False):
+    def prepare_images(self, images, size=768):
+        """Batched equivalent of resize_image, run on the device.
+
+        Args:
+            images (PIL.Image.Image, list, or torch.Tensor): A PIL image, a list of them, or a
+                (3, H, W) or (N, 3, H, W) tensor, either uint8 in [0, 255] or floating point in [0, 1]
+                like the batches read from coco_images_224_float16.hdf5. Floating point inputs are
+                quantized to 8 bits like the PIL images of resize_image and VDVAE.prepare_images.
+            size (int, optional): Length the shorter image side is resized to. Defaults to 768.
+
+        Returns:
+            torch.Tensor: float32 images of shape (N, 3, H', W') on self.device.
+        """
         if isinstance(images, PIL.Image.Image):
-            images = resize_image(images).to(self.device)
-        elif isinstance(images, list):
-            images = torch.stack([resize_image(image).to(self.device) for image in images])
+            images = [images]
+        if isinstance(images, list):
+            if len(set(image.size for image in images)) > 1:
+                return torch.stack([resize_image(image).to(self.device) for image in images])
+            images = torch.stack([transforms.functional.pil_to_tensor(image) for image in images])
+        images = images.to(self.device, non_blocking=True)
+        if images.dim() == 3:
+            images = images.unsqueeze(0)
+        images = images.float() / 255 if images.dtype == torch.uint8 else (images.float() * 255).floor() / 255
+        return transforms.functional.resize(images, size, antialias=True)
+
+    def embed_image(self, images, hidden=False):
+        if isinstance(images, (PIL.Image.Image, list)):
+            images = self.prepare_images(images)
         if images.dim() == 3:
             images = images.unsqueeze(0)
         preprocessed_images = self.extras.clip_preprocess(images)
@@ -87,16 +145,21 @@ class SC_Reconstructor(object):
         return text_encoder_output.hidden_states[-1]
     
     def embed_latent(self, images):
-        if isinstance(images, PIL.Image.Image):
-            images = resize_image(images).to(self.device)
-        elif isinstance(images, list):
-            images = torch.stack([resize_image(image).to(self.device) for image in images])
+        if isinstance(images, (PIL.Image.Image, list)):
+            images = self.prepare_images(images)
         if images.dim() == 3:
             images = images.unsqueeze(0)
         latent_batch = {'images': images}
         effnet_latents = self.core.encode_latents(latent_batch, self.models, self.extras)
         return effnet_latents
         
+    def empty_conditions(self, n_samples):
+        """Returns the cached empty-prompt Stage B conditions and Stage C and B unconditions, expanded to n_samples."""
+        def expand(conditions):
+            return {key: value.expand(n_samples, *value.shape[1:]) if isinstance(value, torch.Tensor) else value
+                    for key, value in conditions.items()}
+        return expand(self.conditions_b), expand(self.unconditions), expand(self.unconditions_b)
+
     def reconstruct(self,
                     image=None, 
                     latent=None,
@@ -114,6 +177,145 @@ class SC_Reconstructor(object):
                     num_steps_b=10,
                     uncond_multiplier=0,
                     guidance_ratio=1):
+        effnet_latents = None
+        if strength < 1.0: # Prepare partially noised latents
+            if latent is not None:
+                effnet_latents = latent.reshape((-1, 16, 24, 24))
+            elif image is not None:
+                effnet_latents = self.embed_latent(image)
+            else:
+                raise ValueError("Image must be provided for strength < 1.0")
+        return self.reconstruct_batch(c_i=c_i.reshape((1, 1, 768)),
+                                      c_t=c_t.reshape((1, 77, 1280)) if c_t is not None else None,
+                                      latents=effnet_latents,
+                                      n_samples=n_samples,
+                                      max_batch_size=n_samples,
+                                      textstrength=textstrength,
+                                      strength=strength,
+                                      num_steps_c=num_steps_c,
+                                      cfg_c=cfg_c,
+                                      cfg_b=cfg_b,
+                                      shift_c=shift_c,
+                                      shift_b=shift_b,
+                                      num_steps_b=num_steps_b,
+                                      uncond_multiplier=uncond_multiplier,
+                                      output_device=self.device)[0]
+
+    def reconstruct_batch(self,
+                          c_i,
+                          c_t=None,
+                          latents=None,
+                          images=None,
+                          n_samples=1,
+                          max_batch_size=16,
+                          textstrength=0.5,
+                          strength=1.0,
+                          num_steps_c=20,
+                          cfg_c=4,
+                          cfg_b=1.1,
+                          shift_c=2,
+                          shift_b=1,
+                          num_steps_b=10,
+                          uncond_multiplier=0,
+                          output_device="cpu"):
+        """Reconstructs a batch of trials, each with its own guidance and init latent.
+
+        Every trial is repeated n_samples times, and the repeats of all trials are run through
+        Stage C and Stage B together in micro-batches of at most max_batch_size images, split
+        into the batch buckets when the generators are compiled (see _micro_batches).
+
+        Args:
+            c_i (torch.Tensor): (N, 1, 768) CLIP image embeddings, one per trial.
+            c_t (torch.Tensor, optional): (N, 77, 1280) CLIP text embeddings. Defaults to the empty prompt.
+            latents (torch.Tensor, optional): (N, 16, 24, 24) effnet latents initializing Stage C when strength < 1.0.
+            images (torch.Tensor, optional): (N, 3, H, W) images prepared like prepare_images, embedded
+                with embed_latent when latents are not given.
+            n_samples (int, optional): Number of reconstructions of each trial. Defaults to 1.
+            max_batch_size (int, optional): Maximum number of images sampled at once. Defaults to 16.
+            output_device (str, optional): Device the reconstructions are gathered on. Defaults to "cpu".
+
+        Returns:
+            torch.Tensor: (N, n_samples, 3, 1024, 1024) reconstructions in [0, 1].
+        """
+        num_trials = len(c_i)
+        if strength < 1.0 and latents is None:
+            if images is None:
+                raise ValueError("Images or latents must be provided for strength < 1.0")
+            with torch.no_grad():
+                latents = torch.cat([self.embed_latent(images[start:start + max_batch_size].to(self.device))
+                                     for start in range(0, num_trials, max_batch_size)])
+        trial_idx = torch.arange(num_trials).repeat_interleave(n_samples)
+        recons = None
+        for start, size, padded_size in self._micro_batches(len(trial_idx), max_batch_size):
+            idx = trial_idx[start:start + size]
+            # Padding repeats the last image and is dropped from the outputs
+            idx = torch.cat([idx, idx[-1:].repeat(padded_size - size)])
+            samples = self._sample(c_i=c_i[idx].to(self.device, self.dtype),
+                                   c_t=c_t[idx].to(self.device, self.dtype) if c_t is not None else None,
+                                   effnet_latents=latents[idx].to(self.device, self.dtype) if strength < 1.0 else None,
+                                   textstrength=textstrength,
+                                   strength=strength,
+                                   num_steps_c=num_steps_c,
+                                   cfg_c=cfg_c,
+                                   cfg_b=cfg_b,
+                                   shift_c=shift_c,
+                                   shift_b=shift_b,
+                                   num_steps_b=num_steps_b,
+                                   uncond_multiplier=uncond_multiplier)[:size]
+            if recons is None:
+                recons = torch.empty((len(trial_idx),) + samples.shape[1:], dtype=samples.dtype, device=output_device)
+            recons[start:start + size] = samples.to(output_device)
+        return recons.view((num_trials, n_samples) + recons.shape[1:])
+
+    def _micro_batches(self, num_images, max_batch_size):
+        """Splits num_images into micro-batches of at most max_batch_size images.
+
+        Without batch buckets, every micro-batch is as large as possible. With them, max_batch_size is
+        clamped down to the largest bucket it holds, so full micro-batches are never padded, and each
+        remainder is split with _bucket_split, so the compiled generators never see a new batch size.
+
+        Returns:
+            list: (start, size, padded size) of every micro-batch.
+        """
+        if self.batch_buckets is not None:
+            max_batch_size = max([bucket for bucket in self.batch_buckets if bucket <= max_batch_size] or self.batch_buckets[:1])
+        micro_batches = []
+        for start in range(0, num_images, max_batch_size):
+            size = min(num_images - start, max_batch_size)
+            if self.batch_buckets is None:
+                micro_batches.append((start, size, size))
+                continue
+            for size, padded_size in self._bucket_split(size):
+                micro_batches.append((start, size, padded_size))
+                start += size
+        return micro_batches
+
+    def _bucket_split(self, num_images):
+        """Splits num_images into batch buckets, padding only the last of them.
+
+        Every generator call is counted as one image more than its padded size, for its fixed overhead,
+        and the split with the least total is picked, e.g. 10 images run as 8 + 2, and 7 as 7 padded to 8
+        rather than as 4 + 2 + 1.
+
+        Returns:
+            list: (size, padded size) of every part, largest first.
+        """
+        # best[n] holds the (cost, number of calls, parts) of the cheapest split of n images
+        best = [(0, 0, [])]
+        for n in range(1, num_images + 1):
+            candidates = []
+            for bucket in self.batch_buckets:
+                if bucket >= n:
+                    candidates.append((bucket + 1, 1, [(n, bucket)]))
+                    break
+                cost, calls, parts = best[n - bucket]
+                candidates.append((cost + bucket + 1, calls + 1, [(bucket, bucket)] + parts))
+            best.append(min(candidates, key=lambda candidate: candidate[:2]))
+        return sorted(best[num_images][2], key=lambda part: (part[0] != part[1], -part[0]))
+
+    def _sample(self, c_i, c_t, effnet_latents, textstrength, strength, num_steps_c, cfg_c, cfg_b, shift_c, shift_b, num_steps_b, uncond_multiplier):
+        """Runs Stage C and Stage B once over a batch of per-image guidance and init latents."""
+        n_samples = len(c_i)
         height, width = 1024, 1024
         stage_c_latent_shape, stage_b_latent_shape = calculate_latent_sizes(height, width, batch_size=n_samples)
         self.extras.sampling_configs['cfg'] = cfg_c
@@ -123,12 +325,6 @@ class SC_Reconstructor(object):
         self.extras_b.sampling_configs['timesteps'] = num_steps_b
         self.extras_b.sampling_configs['t_start'] = 1.0
         if strength < 1.0: # Prepare partially noised latents
-            if latent is not None:
-                effnet_latents = latent.reshape((-1, 16, 24, 24)).expand(n_samples, -1, -1, -1).to(self.device, self.dtype)
-            elif image is not None:
-                effnet_latents = self.embed_latent(image).expand(n_samples, -1, -1, -1).to(self.device, self.dtype)
-            else:
-                raise ValueError("Image must be provided for strength < 1.0")
             t = torch.ones(effnet_latents.size(0), device=self.device) * strength
             noised = self.extras.gdf.diffuse(effnet_latents, t=t)[0]
             self.extras.sampling_configs['timesteps'] = int(num_steps_c * strength)
@@ -137,20 +333,18 @@ class SC_Reconstructor(object):
         else:
             self.extras.sampling_configs['timesteps'] = num_steps_c
             self.extras.sampling_configs['t_start'] = 1.0
-            
+            self.extras.sampling_configs.pop('x_init', None)
+
+        conditions_b, unconditions, unconditions_b = self.empty_conditions(n_samples)
         if int(strength * num_steps_c) > 0:
             
             # Prep CLIP guidance, we are only guiding the first stage
-            conditions = {"clip_text" : c_t.reshape((-1, 77, 1280)).expand(n_samples, -1, -1), 
-                        "clip_text_pooled" : c_t.mean(dim=1).to(self.device, self.dtype), # Placeholder, will replace with uncond guidance
-                        "clip_img" : c_i.reshape((-1,1,768)).expand(n_samples, -1, -1)}
-            #Unconditional guidance
-            batch = {'captions': [""] * n_samples}
-            conditions_b = self.core_b.get_conditions(batch, self.models_b, self.extras_b, is_eval=True, is_unconditional=False)
-            unconditions = self.core.get_conditions(batch, self.models, self.extras, is_eval=True, is_unconditional=True, eval_image_embeds=False)    
-            # These don't matter for guidance
-            conditions["clip_text_pooled"] = unconditions["clip_text_pooled"].to(self.device, self.dtype)
-            unconditions_b = self.core_b.get_conditions(batch, self.models_b, self.extras_b, is_eval=True, is_unconditional=True)
+            if c_t is None:
+                c_t = unconditions["clip_text"]
+            conditions = {"clip_text" : c_t,
+                        # These don't matter for guidance
+                        "clip_text_pooled" : unconditions["clip_text_pooled"].to(self.device, self.dtype),
+                        "clip_img" : c_i}
             
             # Mix the guidance according to text strength, and stabilize with unconditional guidance for small values
             imgstrength = (1-textstrength) 
@@ -171,10 +365,7 @@ class SC_Reconstructor(object):
                 conditions_b['effnet'] = sampled_c
                 unconditions_b['effnet'] = torch.zeros_like(sampled_c)
         else:
-            batch = {'captions': [""] * n_samples}
-            conditions_b = self.core_b.get_conditions(batch, self.models_b, self.extras_b, is_eval=True, is_unconditional=False)
             conditions_b['effnet'] = effnet_latents
-            unconditions_b = self.core_b.get_conditions(batch, self.models_b, self.extras_b, is_eval=True, is_unconditional=True)
             unconditions_b['effnet'] = torch.zeros_like(effnet_latents)
             
         with torch.no_grad(), torch.cuda.amp.autocast(dtype=torch.bfloat16):
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Tests import the src modules the same way the scripts run from the src directory do,
+# where vdvae.py finds the vdvae package modules through sys.path.append('vdvae')
+src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, src)
+sys.path.append(os.path.join(src, "vdvae"))
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+import utils
+
+# More scans than the 2048-row chunks the store is read in
+NUM_SCANS, NUM_VOXELS, CHUNK_ROWS = 5000, 40, 2048
+
+
+class RecordingBetas:
+    """Stands in for a memory-mapped beta store, recording how many rows every read touches."""
+    def __init__(self, betas):
+        self.betas = betas
+        self.shape = betas.shape
+        self.dtype = betas.dtype
+        self.reads = []
+
+    def __getitem__(self, key):
+        out = self.betas[key]
+        self.reads.append(out.numel() // self.shape[1])
+        return out
+
+
+@pytest.fixture
+def nsd(tmp_path, monkeypatch):
+    """Synthetic betas and stimulus info for subject 1: 80 training images and 10 shared1000 images."""
+    rng = np.random.default_rng(0)
+    betas = torch.from_numpy(rng.standard_normal((NUM_SCANS, NUM_VOXELS)).astype(np.float32))
+    betas[:, :3] = 0
+    scan_ids = rng.permutation(NUM_SCANS)[:270].reshape(90, 3) + 1.0
+    scan_ids[rng.random(scan_ids.shape) < 0.1] = np.nan
+    info = pd.DataFrame({"nsdId": np.arange(90), "subject1": 1, "shared1000": np.arange(90) >= 80,
+                         **{f"subject1_rep{j}": scan_ids[:, j] for j in range(3)}})
+    (tmp_path / "nsddata/experiments/nsd").mkdir(parents=True)
+    info.to_csv(tmp_path / "nsddata/experiments/nsd/nsd_stim_info_merged.csv")
+    recording = RecordingBetas(betas)
+    monkeypatch.setattr(utils, "load_beta_store", lambda *args, **kwargs: recording)
+    monkeypatch.setattr(utils, "create_whole_region_unnormalized", lambda **kwargs: None)
+    monkeypatch.setattr(utils, "create_whole_region_normalized", lambda **kwargs: None)
+    return str(tmp_path), betas, scan_ids[:80], recording
+
+
+def test_calculate_snr_mask_matches_calculate_snr(nsd):
+    data_path, betas, scan_ids, _ = nsd
+    # The original implementation gathered every training image into one tensor
+    x_train = torch.zeros((len(scan_ids), 3, NUM_VOXELS))
+    valid = ~np.isnan(scan_ids)
+    x_train[torch.from_numpy(valid)] = betas[scan_ids[valid].astype(int) - 1]
+    snr, _, _ = utils.calculate_snr(x_train)
+    expected = (snr > 0.3) & (betas != 0).any(dim=0)
+    mask = utils.calculate_snr_mask(1, 0.3, betas=betas, data_path=data_path, chunk_images=7)
+    assert torch.equal(mask, expected)
+
+
+def test_create_snr_betas_reads_the_store_in_chunks(nsd, monkeypatch):
+    data_path, betas, _, recording = nsd
+    monkeypatch.setattr(utils, "calculate_snr_mask", lambda subject, threshold, betas, data_path: torch.arange(NUM_VOXELS) % 3 == 0)
+    out = utils.create_snr_betas(subject=1, data_type=torch.float16, data_path=data_path, threshold=0.3)
+    assert torch.equal(out, betas[:, ::3].half())
+    assert max(recording.reads) <= CHUNK_ROWS and sum(recording.reads) == NUM_SCANS
+
+
+def test_calculate_snr_mask_reads_the_store_in_chunks(nsd):
+    data_path, _, _, recording = nsd
+    utils.calculate_snr_mask(1, 0.3, betas=recording, data_path=data_path, chunk_images=10)
+    # Chunks of 10 training images with 3 repeats each, then the nonzero check over row chunks
+    assert max(recording.reads[:-3]) <= 30 and max(recording.reads) <= CHUNK_ROWS
+
+
+def test_load_subject_based_on_rank_order_rois_reads_the_store_in_chunks(nsd, monkeypatch):
+    data_path, betas, _, recording = nsd
+    roi_mask = torch.arange(NUM_VOXELS) < 25
+    monkeypatch.setattr(utils, "top_n_rois_mask", lambda *args, **kwargs: roi_mask)
+    out = utils.load_subject_based_on_rank_order_rois(excluded_subject=1, data_type=torch.float16, top_n_rois=3, data_path=data_path)
+    assert torch.equal(out, betas[:, :25].half())
+    assert max(recording.reads) <= CHUNK_ROWS and sum(recording.reads) == NUM_SCANS
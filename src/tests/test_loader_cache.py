@@ -0,0 +1,62 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+import utils
+
+NUM_SCANS, NUM_VOXELS = 300, 20
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    """Synthetic betas and stimulus info for subject 1: 80 training images and 10 shared1000 images."""
+    rng = np.random.default_rng(0)
+    betas = torch.from_numpy(rng.standard_normal((NUM_SCANS, NUM_VOXELS)).astype(np.float32))
+    scan_ids = rng.permutation(NUM_SCANS)[:270].reshape(90, 3) + 1.0
+    scan_ids[rng.random(scan_ids.shape) < 0.1] = np.nan
+    info = pd.DataFrame({"nsdId": np.arange(90), "subject1": 1, "shared1000": np.arange(90) >= 80,
+                         **{f"subject1_rep{j}": scan_ids[:, j] for j in range(3)}})
+    (tmp_path / "nsddata/experiments/nsd").mkdir(parents=True)
+    info.to_csv(tmp_path / "nsddata/experiments/nsd/nsd_stim_info_merged.csv")
+    monkeypatch.setattr(utils, "load_beta_store", lambda *args, **kwargs: betas)
+    return str(tmp_path)
+
+
+def cache_files(data_path):
+    cache_dir = utils.loader_cache_dir(data_path)
+    return sorted(os.path.relpath(os.path.join(root, name), cache_dir) for root, _, names in os.walk(cache_dir) for name in names)
+
+
+def test_load_nsd_caches_scan_ids_not_betas(data_path):
+    expected = utils.load_nsd(1, num_sessions=1, data_path=data_path, use_cache=False)
+    assert cache_files(data_path) == []
+    for _ in range(2):
+        outputs = utils.load_nsd(1, num_sessions=1, data_path=data_path)
+        for output, reference in zip(outputs, expected):
+            assert np.array_equal(np.asarray(output), np.asarray(reference))
+    # One entry holding the five index arrays, far smaller than the gathered betas
+    entries = {path.split(os.sep)[0] for path in cache_files(data_path)}
+    assert len(entries) == 1 and entries.pop().startswith("nsd_scan_ids_")
+    cached_bytes = sum(os.path.getsize(os.path.join(utils.loader_cache_dir(data_path), path)) for path in cache_files(data_path))
+    assert cached_bytes < expected[0].numel() * expected[0].element_size()
+
+
+def test_changed_source_replaces_its_entry(data_path):
+    first = utils.nsd_scan_ids(1, num_sessions=1, num_scans=NUM_SCANS, data_path=data_path)
+    csv_path = f"{data_path}/nsddata/experiments/nsd/nsd_stim_info_merged.csv"
+    info = pd.read_csv(csv_path, index_col=0)
+    info.loc[info["nsdId"] < 5, "shared1000"] = True
+    info.to_csv(csv_path)
+    os.utime(csv_path, (os.path.getmtime(csv_path) + 10,) * 2)
+    second = utils.nsd_scan_ids(1, num_sessions=1, num_scans=NUM_SCANS, data_path=data_path)
+    assert (len(first[4]), len(second[4])) == (10, 15)
+    assert np.array_equal(second[0], utils.nsd_scan_ids(1, num_sessions=1, num_scans=NUM_SCANS, data_path=data_path, use_cache=False)[0])
+    assert len({path.split(os.sep)[0] for path in cache_files(data_path)}) == 1
+
+
+def test_clear_loader_cache(data_path):
+    utils.nsd_scan_ids(1, num_sessions=1, num_scans=NUM_SCANS, data_path=data_path)
+    assert cache_files(data_path)
+    utils.clear_loader_cache(data_path)
+    assert cache_files(data_path) == []
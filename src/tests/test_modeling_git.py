@@ -0,0 +1,60 @@
+import pytest
+import torch
+
+transformers = pytest.importorskip("transformers")
+if transformers.__version__ != "4.37.2":
+    # modeling_git.py is a copy of the GIT model of the transformers version pinned in requirements.txt
+    pytest.skip(f"modeling_git.py needs transformers 4.37.2, not {transformers.__version__}", allow_module_level=True)
+
+from transformers.models.git.configuration_git import GitConfig
+from modeling_git import GitForCausalLMClipEmb
+
+MAX_LENGTH = 20
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    config = GitConfig(
+        vision_config={"hidden_size": 16, "intermediate_size": 32, "num_hidden_layers": 1, "num_attention_heads": 2, "image_size": 32, "patch_size": 16},
+        vocab_size=40, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64,
+        max_position_embeddings=64, bos_token_id=1, eos_token_id=2, pad_token_id=0,
+        # Large enough weights that every image gets its own caption
+        initializer_range=0.5,
+    )
+    return GitForCausalLMClipEmb(config).eval()
+
+
+@pytest.fixture
+def image_embeds():
+    # 2x2 patches plus the CLS token of the vision config
+    return torch.randn(5, 5, 16, generator=torch.Generator().manual_seed(1))
+
+
+def generate(model, image_embeds):
+    with torch.no_grad():
+        ids = model.generate(pixel_values=image_embeds, max_length=MAX_LENGTH, num_beams=1, do_sample=False)
+    # generate() stops once every caption has ended, generate_captions pads to max_length
+    padding = ids.new_full((len(ids), MAX_LENGTH - ids.shape[1]), model.generation_config.pad_token_id)
+    return torch.cat((ids, padding), dim=1)
+
+
+@pytest.mark.parametrize("batch_size", [2, 256])
+def test_generate_captions_matches_generate(model, image_embeds, batch_size):
+    expected = generate(model, image_embeds)
+    assert torch.equal(model.generate_captions(image_embeds, max_length=MAX_LENGTH, batch_size=batch_size), expected)
+
+
+def test_generate_captions_pads_after_eos(model, image_embeds):
+    # Make a token that some captions emit midway the EOS token, so they end early and are padded
+    ids = model.generate_captions(image_embeds, max_length=MAX_LENGTH)
+    emitted = torch.stack([(ids[:, 2:-1] == token).any(dim=1) for token in range(model.config.vocab_size)]).sum(dim=1)
+    eos_token_id = int(torch.where(emitted < len(ids), emitted, 0).argmax())
+    assert emitted[eos_token_id] > 0
+    model.generation_config.eos_token_id = eos_token_id
+    expected = generate(model, image_embeds)
+    captions = model.generate_captions(image_embeds, max_length=MAX_LENGTH, batch_size=2)
+    assert torch.equal(captions, expected)
+    ended = (captions == eos_token_id).any(dim=1)
+    assert ended.any() and not ended.all()
+    assert (captions[ended, -1] == model.generation_config.pad_token_id).all()
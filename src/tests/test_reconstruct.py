@@ -0,0 +1,101 @@
+import pytest
+import torch
+import reconstruct
+
+NUM_TEST = 7
+BASE_ARGS = ["--model_name", "test", "--device", "cpu", "--no-prompt_recon", "--no-compile_models", "--gen_rep", "3"]
+
+
+class StubReconstructor:
+    """Stands in for SC_Reconstructor, drawing its outputs from the global RNG as Stable Cascade does."""
+
+    def __init__(self, max_calls=None):
+        self.max_calls = max_calls
+        self.calls = 0
+
+    def reconstruct_batch(self, c_i, c_t, images, n_samples, max_batch_size, output_device, **kwargs):
+        self.calls += 1
+        if self.max_calls is not None and self.calls > self.max_calls:
+            raise KeyboardInterrupt
+        noise = torch.rand(len(c_i), n_samples, 3, 4, 4)
+        return noise + c_i[:, :, :1, None, None] + images.mean(dim=(1, 2, 3))[:, None, None, None, None]
+
+    def embed_image(self, images, hidden=False):
+        # Sized like the retrieval predictions the candidates are scored on
+        return images.flatten(1).repeat(1, 86)[:, :257 * 16]
+
+
+class StubVDVAE:
+    def reconstruct_batch(self, latents):
+        return torch.rand(len(latents), 3, 6, 6) + latents[:, :1, None, None]
+
+
+def stub_models(args, device):
+    return StubReconstructor(), StubVDVAE()
+
+
+@pytest.fixture(autouse=True)
+def stub_data(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    generator = torch.Generator().manual_seed(0)
+    preds = {
+        "image": torch.randn(NUM_TEST, 1, 768, generator=generator),
+        "text": torch.randn(NUM_TEST, 77, 1280, generator=generator),
+        "blurry": torch.randn(NUM_TEST, 4, generator=generator),
+        "retrieval": torch.randn(NUM_TEST, 257, 16, generator=generator),
+    }
+    monkeypatch.setattr(reconstruct, "load_data", lambda args: (torch.zeros(NUM_TEST, 1, 10), torch.rand(NUM_TEST, 3, 16, 16)))
+    monkeypatch.setattr(reconstruct, "predict_heads", lambda args, voxels: {name: pred.clone() for name, pred in preds.items()})
+
+
+def run(argv, load_models=stub_models):
+    recons = reconstruct.reconstruct(reconstruct.parse_args(BASE_ARGS + argv), load_models=load_models).clone()
+    return recons, torch.load("evals/test/test_all_blurryrecons_vision.pt")
+
+
+def interrupt_after(num_batches):
+    def load_models(args, device):
+        return StubReconstructor(max_calls=num_batches), StubVDVAE()
+    return load_models
+
+
+@pytest.mark.parametrize("argv", [["--recon_batch_size", "8"], ["--recon_batch_size", "8", "--num_images_per_sample", "1"]])
+def test_resume_matches_uninterrupted_run(tmp_path, argv):
+    expected = run(argv)
+    (tmp_path / "evals").rename(tmp_path / "uninterrupted")
+    with pytest.raises(KeyboardInterrupt):
+        run(argv, load_models=interrupt_after(2))
+    resumed = run(argv + ["--resume"])
+    assert all(torch.equal(result, reference) for result, reference in zip(resumed, expected))
+
+
+@pytest.mark.parametrize("changed", [
+    ["--recon_batch_size", "4"],
+    # Padding to the compiled batch sizes changes the noise drawn
+    ["--recon_batch_size", "8", "--compile_models"],
+])
+def test_resume_refuses_other_batching(changed):
+    with pytest.raises(KeyboardInterrupt):
+        run(["--recon_batch_size", "8", "--num_images_per_sample", "1"], load_models=interrupt_after(1))
+    with pytest.raises(ValueError):
+        run(changed + ["--num_images_per_sample", "1", "--resume"])
+
+
+def test_workers_match_single_process_run(tmp_path, monkeypatch):
+    # Several batches per worker, picking the best of several candidates
+    argv = ["--recon_batch_size", "8", "--num_images_per_sample", "4"]
+    expected = run(argv)
+    (tmp_path / "evals").rename(tmp_path / "single")
+    produced = []
+
+    def recording_run_workers(*args, **kwargs):
+        for item in run_workers(*args, **kwargs):
+            produced.append(item[:2])
+            yield item
+
+    run_workers = reconstruct.run_workers
+    monkeypatch.setattr(reconstruct, "run_workers", recording_run_workers)
+    merged = run(argv + ["--devices", "cpu", "cpu"])
+    # Every (rep, start) batch is generated exactly once, 2 samples per batch over 3 reps
+    assert sorted(produced) == [(rep, start) for rep in range(3) for start in range(0, NUM_TEST, 2)]
+    assert all(torch.equal(result, reference) for result, reference in zip(merged, expected))
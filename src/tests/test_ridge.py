@@ -0,0 +1,157 @@
+import numpy as np
+import pytest
+import torch
+from ridge import RidgeSolver, full_precision_matmul
+
+linear_model = pytest.importorskip("sklearn.linear_model")
+
+
+def make_data(n, p, num_targets, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((n, p)) + rng.standard_normal(p)
+    y = x @ rng.standard_normal((p, num_targets)) / np.sqrt(p) + rng.standard_normal((n, num_targets)) + 3
+    return x, y
+
+
+# Primal form (n > p) and dual form (n < p)
+SHAPES = [(60, 20), (20, 60)]
+
+
+@pytest.mark.parametrize("n, p", SHAPES)
+@pytest.mark.parametrize("fit_intercept", [False, True])
+def test_solve_matches_sklearn(n, p, fit_intercept):
+    x, y = make_data(n, p, 5)
+    solver = RidgeSolver(x, fit_intercept=fit_intercept, dtype=torch.float64)
+    assert solver.dual == (n < p)
+    coef, intercept = solver.solve(y, 3.0, block_size=2)
+    ridge = linear_model.Ridge(alpha=3.0, fit_intercept=fit_intercept).fit(x, y)
+    np.testing.assert_allclose(coef, ridge.coef_, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(intercept, ridge.intercept_ if fit_intercept else 0, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("n, p", SHAPES)
+def test_solve_per_target_alphas_match_sklearn(n, p):
+    # One solution per alpha, of which each target takes its own, as solve_cv does
+    alphas = [0.1, 3.0, 50.0, 1000.0]
+    x, y = make_data(n, p, len(alphas))
+    solutions = RidgeSolver(x, fit_intercept=False, dtype=torch.float64).solve(y, alphas)
+    coef = np.stack([solutions[i][0][i] for i in range(len(alphas))])
+    ridge = linear_model.Ridge(alpha=np.asarray(alphas), fit_intercept=False).fit(x, y)
+    np.testing.assert_allclose(coef, ridge.coef_, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("n, p", SHAPES)
+def test_solve_float32_matches_sklearn(n, p):
+    x, y = make_data(n, p, 3)
+    coef, intercept = RidgeSolver(x.astype(np.float32)).solve(y.astype(np.float32), 3.0)
+    ridge = linear_model.Ridge(alpha=3.0).fit(x, y)
+    np.testing.assert_allclose(coef, ridge.coef_, rtol=1e-3, atol=1e-4)
+    np.testing.assert_allclose(intercept, ridge.intercept_, rtol=1e-3, atol=1e-3)
+
+
+def test_full_precision_matmul_restores_tf32():
+    previous = torch.backends.cuda.matmul.allow_tf32
+    try:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        with full_precision_matmul():
+            assert not torch.backends.cuda.matmul.allow_tf32
+        assert torch.backends.cuda.matmul.allow_tf32
+    finally:
+        torch.backends.cuda.matmul.allow_tf32 = previous
+
+
+def make_cv_data(n, p, seed=0):
+    # Targets from pure noise to mostly signal, so different alphas win, and images repeated 1 to 3 times
+    rng = np.random.default_rng(seed)
+    groups = rng.permutation(np.repeat(np.arange(n), rng.integers(1, 4, size=n)))[:n]
+    images = rng.standard_normal((n, p))
+    x = images[groups] + 0.5 * rng.standard_normal((n, p))
+    signal = images[groups] @ rng.standard_normal((p, 6)) / np.sqrt(p)
+    y = signal * np.array([0, 0.3, 1, 3, 10, 30]) + rng.standard_normal((n, 6))
+    return x, y, groups
+
+
+def leave_group_out_errors(x, y, groups, alphas, fit_intercept):
+    """Mean squared held-out error of every alpha and target, refitting sklearn Ridge without each group."""
+    errors = np.zeros((len(alphas), y.shape[1]))
+    for i, alpha in enumerate(alphas):
+        for group in np.unique(groups):
+            held_out = groups == group
+            ridge = linear_model.Ridge(alpha=alpha, fit_intercept=fit_intercept).fit(x[~held_out], y[~held_out])
+            errors[i] += ((y[held_out] - ridge.predict(x[held_out])) ** 2).sum(axis=0)
+    return errors / len(x)
+
+
+CV_ALPHAS = [0.01, 1.0, 10.0, 100.0, 1e4]
+
+
+@pytest.mark.parametrize("n, p", SHAPES)
+@pytest.mark.parametrize("fit_intercept", [False, True])
+def test_group_inverses_match_refits(n, p, fit_intercept):
+    x, y, groups = make_cv_data(n, p)
+    assert len(set(np.bincount(groups)[np.unique(groups)])) > 1
+    solver = RidgeSolver(x, fit_intercept=fit_intercept, dtype=torch.float64)
+    batches = solver.group_batches(groups, max_rows=5)
+    assert sorted(torch.cat([idx.flatten() for idx in batches]).tolist()) == list(range(n))
+    for alpha in [1.0, 100.0]:
+        coef, intercept = solver.solve(y, alpha)
+        residuals = y - (x @ coef.T + intercept)
+        for idx, inverse in zip(batches, solver.group_inverses(batches, alpha)):
+            for rows, group_inverse in zip(idx.numpy(), inverse.numpy()):
+                held_out = np.isin(np.arange(n), rows)
+                ridge = linear_model.Ridge(alpha=alpha, fit_intercept=fit_intercept).fit(x[~held_out], y[~held_out])
+                np.testing.assert_allclose(group_inverse @ residuals[rows], y[rows] - ridge.predict(x[rows]), rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("n, p", SHAPES)
+@pytest.mark.parametrize("fit_intercept", [False, True])
+def test_solve_cv_alpha_per_target_matches_refits(n, p, fit_intercept):
+    x, y, groups = make_cv_data(n, p)
+    errors = leave_group_out_errors(x, y, groups, CV_ALPHAS, fit_intercept)
+    expected = np.asarray(CV_ALPHAS)[errors.argmin(axis=0)]
+    assert len(set(expected)) > 1
+    solver = RidgeSolver(x, fit_intercept=fit_intercept, dtype=torch.float64)
+    coef, intercept, best_alphas = solver.solve_cv(y, CV_ALPHAS, groups, block_size=4)
+    np.testing.assert_array_equal(best_alphas, expected)
+    for j, alpha in enumerate(best_alphas):
+        ridge = linear_model.Ridge(alpha=alpha, fit_intercept=fit_intercept).fit(x, y[:, j])
+        np.testing.assert_allclose(coef[j], ridge.coef_, rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(intercept[j], ridge.intercept_ if fit_intercept else 0, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("n, p", SHAPES)
+def test_solve_cv_shared_alpha_matches_refits(n, p):
+    x, y, groups = make_cv_data(n, p)
+    errors = leave_group_out_errors(x, y, groups, CV_ALPHAS, True)
+    solver = RidgeSolver(x, dtype=torch.float64)
+    coef, intercept, best_alphas = solver.solve_cv(y, CV_ALPHAS, groups, per_target=False)
+    np.testing.assert_array_equal(best_alphas, CV_ALPHAS[errors.mean(axis=1).argmin()])
+    expected_coef, expected_intercept = solver.solve(y, best_alphas[0])
+    np.testing.assert_array_equal(coef, expected_coef)
+    np.testing.assert_array_equal(intercept, expected_intercept)
+
+
+@pytest.mark.parametrize("n, p", SHAPES)
+def test_reduce_rank_full_rank_matches_solve(n, p):
+    x, y = make_data(n, p, 6)
+    solver = RidgeSolver(x, dtype=torch.float64)
+    coef, intercept = solver.solve(y, 3.0)
+    u, v, reduced_intercept = solver.reduce_rank(coef, intercept, rank=6, block_size=4)
+    assert u.shape == (6, 6) and v.shape == (6, p)
+    np.testing.assert_allclose(u @ v, coef, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(reduced_intercept, intercept, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("n, p", SHAPES)
+@pytest.mark.parametrize("rank", [1, 3])
+def test_reduce_rank_matches_truncated_svd(n, p, rank):
+    x, y = make_data(n, p, 8)
+    solver = RidgeSolver(x, dtype=torch.float64)
+    coef, intercept = solver.solve(y, 3.0)
+    u, v, reduced_intercept = solver.reduce_rank(coef, intercept, rank=rank, block_size=3)
+    # Truncated SVD of the centered training predictions
+    fitted = x @ coef.T + intercept
+    fitted_mean = fitted.mean(axis=0)
+    left, singular, right = np.linalg.svd(fitted - fitted_mean, full_matrices=False)
+    expected = left[:, :rank] * singular[:rank] @ right[:rank] + fitted_mean
+    np.testing.assert_allclose(x @ (u @ v).T + reduced_intercept, expected, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,121 @@
+import os
+import sys
+import types
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+
+@pytest.fixture
+def sc_reconstructor(monkeypatch):
+    # Batching and image preparation do not touch Stable Cascade, so its modules are stood in for when absent
+    try:
+        import train, inference.utils  # noqa: F401
+    except ImportError:
+        monkeypatch.setitem(sys.modules, "inference", types.ModuleType("inference"))
+        monkeypatch.setitem(sys.modules, "inference.utils", types.ModuleType("inference.utils"))
+        monkeypatch.setitem(sys.modules, "train", types.SimpleNamespace(WurstCoreC=None, WurstCoreB=None))
+    monkeypatch.delitem(sys.modules, "sc_reconstructor", raising=False)
+    import sc_reconstructor
+    return sc_reconstructor
+
+
+class StubReconstructor:
+    device = "cpu"
+    dtype = torch.float32
+
+    def __init__(self, batch_buckets):
+        self.batch_buckets = batch_buckets
+        self.batch_sizes = []
+
+    def _sample(self, c_i, c_t, effnet_latents, **kwargs):
+        # One 3x2x2 "image" per row, filled with the first values of its guidance
+        self.batch_sizes.append(len(c_i))
+        return c_i[:, 0, :3, None, None].expand(-1, 3, 2, 2).clone()
+
+
+@pytest.fixture
+def reconstructor(sc_reconstructor):
+    for name in ("reconstruct_batch", "_micro_batches", "_bucket_split"):
+        setattr(StubReconstructor, name, getattr(sc_reconstructor.SC_Reconstructor, name))
+    return StubReconstructor
+
+
+@pytest.mark.parametrize("num_images, max_batch_size, buckets, expected", [
+    (7, 16, None, [(0, 7, 7)]),
+    (21, 16, None, [(0, 16, 16), (16, 5, 5)]),
+    # A small remainder is padded up to the next bucket
+    (7, 16, (1, 2, 4, 8, 16, 32, 64), [(0, 7, 8)]),
+    (15, 16, (1, 2, 4, 8, 16, 32, 64), [(0, 15, 16)]),
+    (1, 16, (4, 8, 16), [(0, 1, 4)]),
+    # A remainder the next bucket would mostly pad is split into buckets
+    (10, 16, (1, 2, 4, 8, 16, 32, 64), [(0, 8, 8), (8, 2, 2)]),
+    (21, 16, (1, 2, 4, 8, 16, 32, 64), [(0, 16, 16), (16, 4, 4), (20, 1, 1)]),
+    (10, 12, (4, 8, 16), [(0, 8, 8), (8, 2, 4)]),
+    # Full micro-batches are never padded, max_batch_size is clamped down to a bucket
+    (40, 64, (4, 8, 16), [(0, 16, 16), (16, 16, 16), (32, 8, 8)]),
+    (20, 12, (4, 8, 16), [(0, 8, 8), (8, 8, 8), (16, 4, 4)]),
+])
+def test_micro_batches(reconstructor, num_images, max_batch_size, buckets, expected):
+    assert reconstructor(buckets)._micro_batches(num_images, max_batch_size) == expected
+
+
+def test_default_reconstruct_batches_are_not_padded(reconstructor):
+    # reconstruct.py runs one sample of gen_rep=10 images per call with --recon_batch_size 16
+    micro_batches = reconstructor((1, 2, 4, 8, 16, 32, 64))._micro_batches(10, 16)
+    assert sum(padded_size for _, _, padded_size in micro_batches) == 10
+
+
+@pytest.mark.parametrize("buckets", [(1, 2, 4, 8, 16, 32, 64), (4, 8, 16), (16,)])
+@pytest.mark.parametrize("n_samples", [3, 10])
+def test_padded_rows_are_dropped(reconstructor, buckets, n_samples):
+    c_i = torch.randn(7, 1, 768)
+    expected = reconstructor(None).reconstruct_batch(c_i, n_samples=n_samples, max_batch_size=16)
+    padded = reconstructor(buckets)
+    recons = padded.reconstruct_batch(c_i, n_samples=n_samples, max_batch_size=16)
+    assert all(size in buckets for size in padded.batch_sizes)
+    assert recons.shape == (7, n_samples, 3, 2, 2)
+    assert torch.equal(recons, expected)
+    assert torch.equal(recons[:, 0, :, 0, 0], c_i[:, 0, :3])
+
+
+@pytest.fixture
+def preparer(sc_reconstructor):
+    # prepare_images only needs the device, so the models are not loaded
+    model = sc_reconstructor.SC_Reconstructor.__new__(sc_reconstructor.SC_Reconstructor)
+    model.device = "cpu"
+    return model
+
+
+@pytest.fixture
+def pixels():
+    return np.random.default_rng(0).integers(0, 256, size=(2, 64, 64, 3), dtype=np.uint8)
+
+
+def test_prepare_images_paths_agree(preparer, pixels):
+    # At size 64 no resizing happens, so PIL, uint8 and float inputs must give the same batch
+    pil = preparer.prepare_images([Image.fromarray(image) for image in pixels], size=64)
+    uint8 = torch.from_numpy(pixels).permute(0, 3, 1, 2)
+    assert torch.equal(preparer.prepare_images(uint8, size=64), pil)
+    assert torch.equal(preparer.prepare_images(uint8.float() / 255, size=64), pil)
+
+
+def test_prepare_images_quantizes_floats(preparer, pixels):
+    images = torch.from_numpy(pixels).permute(0, 3, 1, 2).float() / 255
+    prepared = preparer.prepare_images(images + 0.5 / 255, size=64)
+    assert torch.equal(prepared, preparer.prepare_images(images, size=64))
+
+
+def test_enable_compile_cache_after_inductor_import(sc_reconstructor, tmp_path, monkeypatch):
+    import torch._inductor.config as inductor_config
+    from torch._inductor import codecache
+    monkeypatch.setenv("TORCHINDUCTOR_CACHE_DIR", str(tmp_path / "earlier"))
+    monkeypatch.setenv("TRITON_CACHE_DIR", str(tmp_path / "earlier"))
+    if hasattr(inductor_config, "fx_graph_cache"):
+        monkeypatch.setattr(inductor_config, "fx_graph_cache", inductor_config.fx_graph_cache)
+    # Inductor has already looked up its cache directory, as after an earlier compiled call
+    codecache.cache_dir()
+    sc_reconstructor.enable_compile_cache(str(tmp_path / "compile"))
+    assert codecache.cache_dir() == str(tmp_path / "compile" / "inductor")
+    assert os.environ["TRITON_CACHE_DIR"] == str(tmp_path / "compile" / "triton")
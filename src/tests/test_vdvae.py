@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+vdvae = pytest.importorskip("vdvae")
+
+
+@pytest.fixture
+def model():
+    # prepare_images only needs the device, so the weights are not loaded
+    model = vdvae.VDVAE.__new__(vdvae.VDVAE)
+    model.device = "cpu"
+    return model
+
+
+@pytest.fixture
+def pixels():
+    return np.random.default_rng(0).integers(0, 256, size=(2, 64, 64, 3), dtype=np.uint8)
+
+
+def test_prepare_images_paths_agree(model, pixels):
+    # At 64x64 no resizing happens, so PIL, uint8 and float inputs must give the same batch
+    pil = model.prepare_images([Image.fromarray(image) for image in pixels])
+    uint8 = torch.from_numpy(pixels).permute(0, 3, 1, 2)
+    assert torch.equal(model.prepare_images(uint8), pil)
+    assert torch.equal(model.prepare_images(uint8.float() / 255), pil)
+
+
+def test_prepare_images_quantizes_floats(model, pixels):
+    images = torch.from_numpy(pixels).permute(0, 3, 1, 2).float() / 255
+    prepared = model.prepare_images(images + 0.5 / 255)
+    assert torch.equal(prepared, prepared.floor())
+    assert torch.equal(prepared, model.prepare_images(images))
@@ -21,6 +21,12 @@ from PIL import Image
 import requests
 import time 
 import h5py
+import hashlib
+import inspect
+import functools
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -426,19 +432,42 @@ def versatile_diffusion_recon(brain_clip_embeddings,
     
     return recon_img, brain_recons, best_picks
 
+def score_recons(brain_recons, proj_embeddings, clip_extractor, hidden=False, batch_size=32):
+    """Cosine similarity of each candidate reconstruction's CLIP embedding to its sample's predicted embedding.
+
+    Args:
+        brain_recons (torch.Tensor): (num_samples, num_candidates, 3, H, W) candidate reconstructions,
+            or (num_candidates, 3, H, W) for a single sample.
+        proj_embeddings (torch.Tensor): (num_samples, ...) predicted retrieval or CLIP image embeddings.
+        clip_extractor (SC_Reconstructor): Embeds the candidates with embed_image.
+        hidden (bool, optional): Score the hidden states instead of the pooled embeddings. Defaults to False.
+        batch_size (int, optional): Candidates embedded per forward pass. Defaults to 32.
+
+    Returns:
+        torch.Tensor: (num_samples, num_candidates) scores on proj_embeddings.device.
+    """
+    if brain_recons.dim() == 4:
+        brain_recons = brain_recons.unsqueeze(0)
+    num_samples, num_candidates = brain_recons.shape[:2]
+    candidates = brain_recons.flatten(0, 1)
+    with torch.no_grad():
+        recon_embeddings = torch.cat([clip_extractor.embed_image(candidates[start:start + batch_size], hidden=hidden).to(proj_embeddings.device, proj_embeddings.dtype)
+                                      for start in range(0, len(candidates), batch_size)])
+    reference = nn.functional.normalize(proj_embeddings.reshape(num_samples, -1), dim=-1)
+    recon_embeddings = nn.functional.normalize(recon_embeddings.reshape(num_samples, num_candidates, -1), dim=-1)
+    return torch.einsum("sd,scd->sc", reference, recon_embeddings)
+
+def pick_best_recons(brain_recons, proj_embeddings, clip_extractor, hidden=False, k=1, batch_size=32):
+    """Batched best-of-N selection: returns the (num_samples, k) indices of the best scoring candidates
+    of each sample, best first, and the (num_samples, num_candidates) scores from score_recons."""
+    scores = score_recons(brain_recons, proj_embeddings, clip_extractor, hidden=hidden, batch_size=batch_size)
+    best_idx = scores.nan_to_num(nan=-float("inf")).topk(k, dim=1).indices
+    return best_idx, scores
+
 def pick_best_recon(brain_recons, proj_embeddings, clip_extractor, hidden=False):
     # pick best reconstruction out of several
-    best_picks = np.zeros(1).astype(np.int16)
-    v2c_reference_out = nn.functional.normalize(proj_embeddings.view(len(proj_embeddings),-1),dim=-1)
-    sims=[]
-    for im in range(len(brain_recons)): 
-        currecon = clip_extractor.embed_image(brain_recons[im], hidden=hidden).to(proj_embeddings.device).to(proj_embeddings.dtype)
-        currecon = nn.functional.normalize(currecon.view(len(currecon),-1),dim=-1)
-        cursim = batchwise_cosine_similarity(v2c_reference_out,currecon)
-        sims.append(cursim.item())
-    best_picks[0] = int(np.nanargmax(sims))  
-     
-    recon_img = brain_recons[best_picks[0]]
+    best_idx, _ = pick_best_recons(brain_recons, proj_embeddings, clip_extractor, hidden=hidden)
+    recon_img = brain_recons[best_idx[0, 0].item()]
     
     return recon_img
 
@@ -665,6 +694,99 @@ def condition_average_old(x, y, cond, nest=False):
 
     return avg_x, y, len(idx_count)
 
+def loader_cache_dir(data_path):
+    """Directory cached_loader keeps its entries in; delete it, or call clear_loader_cache, to clear the cache."""
+    return f"{data_path}/preprocessed_data/loader_cache"
+
+def clear_loader_cache(data_path):
+    """Deletes every cached_loader entry under data_path."""
+    shutil.rmtree(loader_cache_dir(data_path), ignore_errors=True)
+
+def cached_loader(source_files):
+    """Caches the derived outputs of a dataset function on disk, keyed by its arguments and source file mtimes.
+
+    Meant for the small scan indices and voxel masks that take real work to derive, like parsing
+    nsd_stim_info_merged.csv or combining the ROI masks of every subject, and not for betas or
+    images, which are already on disk and would only be copied. Outputs (tensors and numpy arrays,
+    or tuples of them) are stored as raw .npy files in {data_path}/preprocessed_data/loader_cache/
+    (see loader_cache_dir), one directory per function and argument combination, and memory-mapped
+    back on a hit. An entry whose source files changed since is recomputed in place, so the cache
+    holds at most one entry per argument combination. Delete the directory, or call
+    clear_loader_cache, to clear it. The wrapped function accepts an extra use_cache=False keyword
+    to bypass the cache.
+
+    Args:
+        source_files (callable): Maps the function's bound arguments (a dict) to the list of files
+            it reads. Missing files are recorded too, so creating one invalidates the entry.
+    """
+    def decorator(loader):
+        signature = inspect.signature(loader)
+
+        @functools.wraps(loader)
+        def wrapper(*args, use_cache=True, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            # Betas passed in directly can't be keyed cheaply, so always recompute
+            if not use_cache or params.get("betas") is not None:
+                return loader(*args, **kwargs)
+            data_path = params.get("data_path", params.get("data_root"))
+            sources = {os.path.abspath(path): os.path.getmtime(path) if os.path.exists(path) else None
+                       for path in source_files(params)}
+            key = json.dumps({"loader": loader.__name__, "args": params}, sort_keys=True, default=str)
+            digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+            cache_dir = f"{loader_cache_dir(data_path)}/{loader.__name__}_{digest}"
+
+            if os.path.exists(f"{cache_dir}/manifest.json"):
+                with open(f"{cache_dir}/manifest.json", 'r') as f:
+                    manifest = json.load(f)
+                if manifest["sources"] == sources:
+                    outputs = []
+                    for i, kind in enumerate(manifest["outputs"]):
+                        array = np.load(f"{cache_dir}/{i}.npy", mmap_mode='c')
+                        outputs.append(torch.from_numpy(array) if kind == "tensor" else np.asarray(array))
+                    return tuple(outputs) if manifest["tuple"] else outputs[0]
+
+            result = loader(*args, **kwargs)
+            outputs = result if isinstance(result, tuple) else (result,)
+            tmp_dir = cache_dir + ".tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            kinds = []
+            for i, output in enumerate(outputs):
+                if torch.is_tensor(output):
+                    kinds.append("tensor")
+                    output = output.detach().cpu().numpy()
+                else:
+                    kinds.append("array")
+                np.save(f"{tmp_dir}/{i}.npy", np.asarray(output), allow_pickle=False)
+            with open(f"{tmp_dir}/manifest.json", 'w') as f:
+                json.dump({"key": json.loads(key), "sources": sources, "outputs": kinds, "tuple": isinstance(result, tuple)}, f)
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            os.replace(tmp_dir, cache_dir)
+            return result
+        return wrapper
+    return decorator
+
+def _top_n_rois_sources(params):
+    data_path, subject = params["data_path"], params["excluded_subject"]
+    suffix = "samplewise_nsd_general" if params["nsd_general"] else "samplewise" if params["samplewise"] else "voxelwise"
+    mask_suffix = "_nsd_general" if params["nsd_general"] else ""
+    sources = [f"{data_path}/subj0{subject}_sorted_rois_rank_order_{suffix}.json"]
+    for i in range(1, 9):
+        sources += [f"{data_path}/combined_masks/subj0{i}_combined_mask{mask_suffix}.nii.gz",
+                    f"{data_path}/combined_masks/subj0{i}_labels{mask_suffix}.txt",
+                    f"{data_path}/nsddata/ppdata/subj0{i}/func1pt8mm/roi/brainmask_inflated_1.0.nii"]
+    return sources
+
+def _snr_mask_sources(params):
+    data_path, subject = params["data_path"], params["subject"]
+    return [f"{data_path}/preprocessed_data/subject{subject}/whole_brain_include_heldout.pt",
+            f"{data_path}/nsddata/experiments/nsd/nsd_stim_info_merged.csv"]
+
+def _nsd_scan_ids_sources(params):
+    return [f"{params['data_path']}/nsddata/experiments/nsd/nsd_stim_info_merged.csv"]
+
 #subject: nsd subject index between 1-8
 #mode: vision, imagery
 #stimtype: all, simple, complex, concepts
@@ -866,11 +988,12 @@ def read_betas(subject, session_index, trial_index=[], data_type='betas_fithrf_G
         data_format : str, optional
             what type of data format, from ['fsaverage', 'func1pt8mm', 'func1mm'], by default 'fsaverage'
         mask : numpy.ndarray, if defined, selects 'mat' data_format, needs volumetric data_format
-            binary/boolean mask into mat file beta data format.
+            binary/boolean mask into mat file beta data format. The masked betas are returned
+            as (voxels, trials) in the dtype stored on disk (int16 for NSD) instead of float64.
 
         Returns
         -------
-        numpy.ndarray, 2D (fsaverage) or 4D (other data formats)
+        numpy.ndarray, 2D (fsaverage or masked) or 4D (other data formats)
             the requested per-trial beta values
         """
 
@@ -878,8 +1001,13 @@ def read_betas(subject, session_index, trial_index=[], data_type='betas_fithrf_G
         
         si_str = str(session_index).zfill(2)
 
-        out_data = nb.load(
-            op.join(data_folder, f'betas_session{si_str}.nii.gz')).get_fdata()
+        img = nb.load(op.join(data_folder, f'betas_session{si_str}.nii.gz'))
+        if mask is not None:
+            # One vectorized fancy-index over the flattened volume, without upcasting to float64
+            out_data = np.asanyarray(img.dataobj)
+            out_data = out_data.reshape((-1, out_data.shape[-1]))[np.asarray(mask, dtype=bool).flatten()]
+        else:
+            out_data = img.get_fdata()
 
         if len(trial_index) == 0:
             trial_index = slice(0, out_data.shape[-1])
@@ -888,17 +1016,22 @@ def read_betas(subject, session_index, trial_index=[], data_type='betas_fithrf_G
 
 
 def create_whole_region_unnormalized(subject: int = 1, include_heldout: bool = True, 
-                                     mask_nsd_general: bool = False, data_path="../dataset") -> None:
+                                     mask_nsd_general: bool = False, data_path="../dataset",
+                                     num_workers: int = 4) -> None:
     """Creates and saves an unnormalized whole region tensor for a given subject.
 
     This function loads, processes, and saves whole region neural data for a given subject. 
     The data can be optionally masked using the NSD general mask, and include held-out sessions.
+    Sessions are decompressed by a pool of worker threads, masked in their native dtype, and
+    streamed into a preallocated temporary .npy memory map that is then saved as the .pt tensor,
+    so only a few sessions are in memory at once.
 
     Args:
         subject (int, optional): The subject number (1-8). Defaults to 1.
         include_heldout (bool, optional): Whether to include held-out data. Defaults to True.
         mask_nsd_general (bool, optional): Whether to apply the NSD general mask. Defaults to False.
         data_path (str, optional): The path to the data directory. Defaults to "../dataset".
+        num_workers (int, optional): Number of sessions decompressed in parallel. Defaults to 4.
 
     Returns:
         None: The function saves the processed tensor to a file and does not return anything.
@@ -937,37 +1070,48 @@ def create_whole_region_unnormalized(subject: int = 1, include_heldout: bool = T
     layer_size = np.sum(mask == True)
     
     data = num_scans[subject]
-    whole_region = torch.zeros((750 * data, layer_size))
 
     mask = np.nan_to_num(mask)
     mask = np.array(mask.flatten(), dtype=bool)
-    
-    # Loads the full collection of beta sessions for subject 1
-    for i in tqdm(range(1, data + 1), desc="Loading raw scanning session data"):
-        beta = read_betas(subject="subj0" + str(subject), 
-                                session_index=i, 
-                                trial_index=[], # Empty list as index means get all 750 scans for this session (trial --> scan)
-                                data_type="betas_fithrf_GLMdenoise_RR",
-                                data_format='func1pt8mm',
-                                data_path=data_path)
-            
-        # Reshape the beta trails to be flattened. 
-        beta = beta.reshape((mask.shape[0], beta.shape[3]))
 
-        for j in range(beta.shape[1]):
-
-            # Grab the current beta trail. 
-            current_scan = beta[:, j]
-            
-            # One scan session. 
-            single_scan = torch.from_numpy(current_scan)
-
-            # Discard the unmasked values and keeps the masked values. 
-            whole_region[j + (i-1)*beta.shape[1]] = single_scan[mask]
-            
-    # Save the tensor into the data directory. 
-    torch.nan_to_num(whole_region)
-    torch.save(whole_region, file_path)
+    # Preallocate the output in a temporary memory-mapped file, so the sessions never all sit in memory
+    tmp_path = os.path.splitext(file_path)[0] + ".tmp.npy"
+    whole_region = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(750 * data, int(layer_size)))
+
+    def load_session(i):
+        # Masked betas for the session, (voxels, 750 scans) in the stored dtype
+        return read_betas(subject="subj0" + str(subject), 
+                          session_index=i, 
+                          trial_index=[], # Empty list as index means get all 750 scans for this session (trial --> scan)
+                          data_type="betas_fithrf_GLMdenoise_RR",
+                          data_format='func1pt8mm',
+                          mask=mask,
+                          data_path=data_path)
+
+    # Decompress sessions in a worker pool, keeping at most num_workers sessions in flight and writing them in order
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque(executor.submit(load_session, i) for i in range(1, min(num_workers, data) + 1))
+        next_session = len(pending) + 1
+        for i in tqdm(range(1, data + 1), desc="Loading raw scanning session data"):
+            beta = pending.popleft().result()
+            if next_session <= data:
+                pending.append(executor.submit(load_session, next_session))
+                next_session += 1
+            rows = slice((i - 1) * beta.shape[1], i * beta.shape[1])
+            whole_region[rows] = beta.T
+            del beta
+
+    # Save the tensor into the data directory, streamed from the memory map and renamed into place
+    # once complete, so an interrupted run is never mistaken for a finished one
+    whole_region.flush()
+    torch.save(torch.from_numpy(whole_region), file_path + ".tmp")
+    del whole_region
+    os.replace(file_path + ".tmp", file_path)
+    os.remove(tmp_path)
+
+def load_whole_region_unnormalized(file_path):
+    """Opens a .pt file saved by create_whole_region_unnormalized memory-mapped, so rows are only read when indexed."""
+    return torch.load(file_path, mmap=True)
 
 def zscore(x, mean=None, stddev=None, return_stats=False):
     if mean is not None:
@@ -983,7 +1127,14 @@ def zscore(x, mean=None, stddev=None, return_stats=False):
     else:
         return (x - m)/(s+1e-6)
     
-def create_whole_region_normalized(subject = 1, include_heldout=False, mask_nsd_general=False, data_path="../dataset/"):
+def create_whole_region_normalized(subject = 1, include_heldout=False, mask_nsd_general=False, data_path="../dataset/", chunk_rows=1024):
+    """Z-scores every voxel of the unnormalized whole region data using statistics from the training scans.
+
+    Per-voxel mean and standard deviation are accumulated over the training rows in chunks with
+    Welford's algorithm, then applied block-wise while streaming the result into the .pt file, the
+    betas_all_whole_brain HDF5 file and its memory-mapped beta store. Only one block of rows is ever
+    held in memory, so this works out-of-core on whole-brain data.
+    """
         
     if include_heldout and mask_nsd_general:
         file = f"{data_path}/preprocessed_data/subject{subject}/nsd_general_include_heldout.pt"
@@ -991,7 +1142,7 @@ def create_whole_region_normalized(subject = 1, include_heldout=False, mask_nsd_
         # File has already been created
         if os.path.exists(file): return
         
-        whole_region = torch.load(f"{data_path}/preprocessed_data/subject{subject}/nsd_general_unnormalized_include_heldout.pt")
+        whole_region = load_whole_region_unnormalized(f"{data_path}/preprocessed_data/subject{subject}/nsd_general_unnormalized_include_heldout.pt")
         numScans = {1: 40, 2: 40, 3:32, 4: 30, 5:40, 6:32, 7:40, 8:30}
         
     elif include_heldout and not mask_nsd_general:
@@ -1000,7 +1151,7 @@ def create_whole_region_normalized(subject = 1, include_heldout=False, mask_nsd_
         # File has already been created
         if os.path.exists(file): return
         
-        whole_region = torch.load(f"{data_path}/preprocessed_data/subject{subject}/whole_brain_unnormalized_include_heldout.pt")
+        whole_region = load_whole_region_unnormalized(f"{data_path}/preprocessed_data/subject{subject}/whole_brain_unnormalized_include_heldout.pt")
         numScans = {1: 40, 2: 40, 3:32, 4: 30, 5:40, 6:32, 7:40, 8:30}
         
     elif not include_heldout and not mask_nsd_general:
@@ -1009,7 +1160,7 @@ def create_whole_region_normalized(subject = 1, include_heldout=False, mask_nsd_
         # File has already been created
         if os.path.exists(file): return
         
-        whole_region = torch.load(f"{data_path}/preprocessed_data/subject{subject}/whole_brain_unnormalized.pt")
+        whole_region = load_whole_region_unnormalized(f"{data_path}/preprocessed_data/subject{subject}/whole_brain_unnormalized.pt")
         numScans = {1: 40, 2: 40, 3:32, 4: 30, 5:40, 6:32, 7:40, 8:30}
         
     else:
@@ -1018,32 +1169,48 @@ def create_whole_region_normalized(subject = 1, include_heldout=False, mask_nsd_
         # File has already been created
         if os.path.exists(file): return
         
-        whole_region = torch.load(f"{data_path}/preprocessed_data/subject{subjec}/nsd_general_unnormalized.pt")
+        whole_region = load_whole_region_unnormalized(f"{data_path}/preprocessed_data/subject{subject}/nsd_general_unnormalized.pt")
         numScans = {1: 37, 2: 37, 3:32, 4: 30, 5:37, 6:32, 7:37, 8:30}
     
-    whole_region_norm = torch.zeros_like(whole_region)
-    
     stim_descriptions = pd.read_csv(f'{data_path}/nsddata/experiments/nsd/nsd_stim_info_merged.csv', index_col=0)
     subj_train = stim_descriptions[(stim_descriptions[f'subject{subject}'] != 0) & (stim_descriptions['shared1000'] == False)]
-    train_ids = []
-    
-    for i in range(subj_train.shape[0]):
-        for j in range(3):
-            scanID = subj_train.iloc[i][f'subject{subject}_rep{j}'] - 1
-            if scanID < numScans[subject]*750:
-                train_ids.append(scanID)
-    normalizing_data = whole_region[torch.tensor(train_ids)]
-    print(normalizing_data.shape, whole_region.shape)
-    
-    # Normalize the data using Z scoring method for each voxel
-    for i in range(normalizing_data.shape[1]):
-        voxel_mean, voxel_std = torch.mean(normalizing_data[:, i]), torch.std(normalizing_data[:, i])  
-        normalized_voxel = (whole_region[:, i] - voxel_mean) / voxel_std
-        whole_region_norm[:, i] = normalized_voxel
-
-    # Save the tensor of normalized data
-    torch.save(whole_region_norm, file)
-    convert_from_pt_to_hdf5(file, f"{data_path}/betas_all_whole_brain_subj{subject:02d}_fp32_renorm.hdf5")
+    scan_ids = subj_train[[f'subject{subject}_rep{j}' for j in range(3)]].values.flatten() - 1
+    train_ids = np.sort(scan_ids[scan_ids < numScans[subject]*750].astype(np.int64))
+    print((len(train_ids), whole_region.shape[1]), whole_region.shape)
+
+    # Accumulate per-voxel mean and variance over the training scans with Welford's algorithm, merging chunk statistics
+    count = 0
+    voxel_mean = torch.zeros(whole_region.shape[1], dtype=torch.float64)
+    voxel_m2 = torch.zeros(whole_region.shape[1], dtype=torch.float64)
+    for start in range(0, len(train_ids), chunk_rows):
+        chunk = whole_region[torch.from_numpy(train_ids[start:start + chunk_rows])].to(torch.float64)
+        chunk_count, chunk_mean = len(chunk), chunk.mean(dim=0)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(dim=0)
+        delta = chunk_mean - voxel_mean
+        total = count + chunk_count
+        voxel_mean += delta * chunk_count / total
+        voxel_m2 += chunk_m2 + delta ** 2 * count * chunk_count / total
+        count = total
+    voxel_std = torch.sqrt(voxel_m2 / (count - 1)).to(torch.float32)
+    voxel_mean = voxel_mean.to(torch.float32)
+
+    # Normalize the data using Z scoring method for each voxel, one block of rows at a time
+    hdf5_path = f"{data_path}/betas_all_whole_brain_subj{subject:02d}_fp32_renorm.hdf5"
+    store_path = os.path.splitext(hdf5_path)[0] + ".npy"
+    whole_region_norm = np.lib.format.open_memmap(store_path + ".tmp", mode='w+', dtype=np.float32, shape=tuple(whole_region.shape))
+    with h5py.File(hdf5_path, 'w') as hdf:
+        dset = hdf.create_dataset('betas', shape=tuple(whole_region.shape), dtype=np.float32)
+        for start in tqdm(range(0, whole_region.shape[0], chunk_rows), desc="Normalizing voxels"):
+            block = ((whole_region[start:start + chunk_rows] - voxel_mean) / voxel_std).numpy()
+            whole_region_norm[start:start + chunk_rows] = block
+            dset[start:start + chunk_rows] = block
+    whole_region_norm.flush()
+
+    # Save the tensor of normalized data, streamed from the memory map
+    torch.save(torch.from_numpy(whole_region_norm), file)
+    del whole_region_norm
+    os.replace(store_path + ".tmp", store_path)
+    write_beta_store_index(store_path, hdf5_path, whole_region.shape, np.float32)
     
 def create_whole_region_imagery_unnormalized(subject = 1, mask=True, GLMdenoise=True, data_path="../dataset/"):
     
@@ -1140,35 +1307,345 @@ def calculate_snr(betas):
     snr = torch.nan_to_num(snr)
     return snr, signal, noise
 
+def create_beta_store(hdf5_path, store_path=None, chunk_rows=2048):
+    """Converts the 'betas' dataset of an HDF5 file into a memory-mappable beta store.
+
+    The store is a raw .npy array next to the HDF5 file plus a small JSON index
+    recording its shape, dtype and the mtime of the HDF5 file it was built from.
+    Rows are streamed across in chunks, so the full matrix is never held in memory.
+
+    Args:
+        hdf5_path (str): Path to the betas_all_*.hdf5 file.
+        store_path (str, optional): Path of the .npy store. Defaults to hdf5_path with a .npy suffix.
+        chunk_rows (int, optional): Number of rows copied per chunk. Defaults to 2048.
+
+    Returns:
+        str: The path of the .npy store.
+    """
+    if store_path is None:
+        store_path = os.path.splitext(hdf5_path)[0] + ".npy"
+    tmp_path = store_path + ".tmp"
+    with h5py.File(hdf5_path, 'r') as f:
+        dset = f['betas']
+        store = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dset.dtype, shape=dset.shape)
+        for start in tqdm(range(0, dset.shape[0], chunk_rows), desc=f"Creating beta store {os.path.basename(store_path)}"):
+            store[start:start + chunk_rows] = dset[start:start + chunk_rows]
+        store.flush()
+        shape, dtype = dset.shape, dset.dtype
+    del store
+    os.replace(tmp_path, store_path)
+    write_beta_store_index(store_path, hdf5_path, shape, dtype)
+    return store_path
+
+def write_beta_store_index(store_path, hdf5_path, shape, dtype):
+    """Writes the JSON index that marks a .npy beta store as up to date with its HDF5 source."""
+    index = {"shape": [int(n) for n in shape], "dtype": str(np.dtype(dtype)),
+             "source": os.path.abspath(hdf5_path), "source_mtime": os.path.getmtime(hdf5_path)}
+    with open(os.path.splitext(store_path)[0] + ".json", 'w') as f:
+        json.dump(index, f)
+
+def load_beta_store(hdf5_path, store_path=None):
+    """Opens the beta store for an HDF5 betas file lazily, creating or refreshing it if needed.
+
+    Returns a torch tensor that is a zero-copy view over a copy-on-write memory map,
+    so only the rows that are actually indexed get read from disk.
+    """
+    if store_path is None:
+        store_path = os.path.splitext(hdf5_path)[0] + ".npy"
+    index_path = os.path.splitext(store_path)[0] + ".json"
+    stale = not (os.path.exists(store_path) and os.path.exists(index_path))
+    if not stale and os.path.exists(hdf5_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        stale = index["source_mtime"] != os.path.getmtime(hdf5_path)
+    if stale:
+        create_beta_store(hdf5_path, store_path)
+    return torch.from_numpy(np.load(store_path, mmap_mode='c'))
+
+def gather_betas(betas, scan_ids, chunk_rows=2048):
+    """Gathers rows of betas for the given scan IDs into a new contiguous tensor.
+
+    Rows are read in ascending scan ID order in chunks, which turns reads from a
+    memory-mapped beta store into sequential bulk reads, and are scattered directly
+    into the preallocated output to avoid holding a second copy of the result.
+    """
+    scan_ids = torch.as_tensor(np.asarray(scan_ids), dtype=torch.long)
+    order = torch.argsort(scan_ids)
+    out = torch.empty((len(scan_ids),) + tuple(betas.shape[1:]), dtype=betas.dtype)
+    for start in range(0, len(order), chunk_rows):
+        chunk = order[start:start + chunk_rows]
+        out[chunk] = betas[scan_ids[chunk]]
+    return out
+
+def mask_betas(betas, voxel_mask=None, dtype=None, chunk_rows=2048):
+    """Copies the voxel_mask columns of betas, converted to dtype, into a new tensor a chunk of rows at a time.
+
+    Masking or converting a memory-mapped beta store in one go reads the whole store into memory
+    first, while this keeps peak memory at the size of the output plus one chunk. Without a mask
+    or a dtype change, betas is returned as is, so it stays lazy.
+    """
+    dtype = dtype or betas.dtype
+    if voxel_mask is None and dtype == betas.dtype:
+        return betas
+    voxel_mask = torch.ones(betas.shape[1], dtype=torch.bool) if voxel_mask is None else torch.as_tensor(voxel_mask, dtype=torch.bool)
+    out = torch.empty((betas.shape[0], int(voxel_mask.sum())), dtype=dtype)
+    for start in range(0, betas.shape[0], chunk_rows):
+        out[start:start + chunk_rows] = betas[start:start + chunk_rows][:, voxel_mask].to(dtype)
+    return out
+
+def gather_betas_masked(betas, scan_ids, valid_mask, fill_value=0.0):
+    """Gathers betas for an array of scan IDs of any shape in a single vectorized pass.
+
+    Entries where valid_mask is False are filled with fill_value instead of being read.
+    Returns a tensor of shape scan_ids.shape + betas.shape[1:].
+    """
+    valid_mask = torch.from_numpy(np.asarray(valid_mask, dtype=bool))
+    # Point invalid entries at row 0 so the whole array can be gathered at once, then overwrite them
+    safe_ids = torch.from_numpy(np.where(valid_mask.numpy(), scan_ids, 0).astype(np.int64))
+    out = betas[safe_ids]
+    out[~valid_mask] = fill_value
+    return out
+
+def embedding_bank_path(data_path, variant, kind):
+    """Path of the shared embedding bank for one embedding variant, e.g. ("stable_cascade", "image")."""
+    return f"{data_path}/preprocessed_data/embedding_bank/{variant}_{kind}_embeddings.npy"
+
+def create_embedding_bank(bank_path, embed_fn, num_items, batch_size=64, dtype=np.float32, shard_size=1024,
+                          worker_id=0, num_workers=1, consolidate=True):
+    """Embeds all 73k NSD images (or their captions) once into a bank indexed by NSD image ID.
+
+    The bank is a raw .npy array that every subject and session count gathers its training
+    targets from, instead of re-embedding the same shared images per subject. Embeddings are
+    written as fixed-size shards to {bank_path}.shards as they are computed, next to a manifest
+    of the shard layout, so an interrupted run resumes after its last finished shard. Shards
+    are split round-robin between workers, so several processes or GPUs can fill one bank by
+    calling this with the same arguments and different worker_id values; see
+    consolidate_embedding_bank for merging their shards afterwards.
+
+    Args:
+        bank_path (str): Output .npy path, see embedding_bank_path.
+        embed_fn (callable): Maps a (start, end) range of NSD image IDs to a tensor of embeddings
+            of shape (end - start, ...).
+        num_items (int): Number of NSD image IDs to embed, normally 73000.
+        batch_size (int, optional): Number of IDs passed to embed_fn at a time. Defaults to 64.
+        dtype (np.dtype, optional): Storage dtype. Defaults to np.float32, the dtype of the training
+            targets; np.float16 halves the size of the large banks at the cost of quantizing them.
+        shard_size (int, optional): Number of IDs per shard. Defaults to 1024.
+        worker_id (int, optional): Index of this worker. Defaults to 0.
+        num_workers (int, optional): Number of workers sharing the shards. Defaults to 1.
+        consolidate (bool, optional): Merge the shards into bank_path once they are all finished.
+            Defaults to True.
+
+    Returns:
+        str: bank_path.
+    """
+    shard_dir = bank_path + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest = {"num_items": int(num_items), "shard_size": int(shard_size), "dtype": str(np.dtype(dtype))}
+    manifest_path = f"{shard_dir}/manifest.json"
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            existing = json.load(f)
+        if existing != manifest:
+            raise ValueError(f"{shard_dir} was started with {existing}, not {manifest}; delete it to start over")
+    else:
+        # Unique temporary name, as several workers may write the same manifest at once
+        tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+    _, missing = embedding_bank_progress(bank_path)
+    pending = [(start, end) for start, end in missing if (start // shard_size) % num_workers == worker_id]
+    with torch.no_grad():
+        for start, end in tqdm(pending, desc=f"Embedding shards of {os.path.basename(bank_path)} (worker {worker_id})"):
+            shard = np.concatenate([
+                torch.as_tensor(embed_fn(i, min(i + batch_size, end))).float().cpu().numpy().astype(dtype)
+                for i in range(start, end, batch_size)
+            ])
+            tmp_path = f"{shard_dir}/{start:06d}_{end:06d}.tmp.npy"
+            np.save(tmp_path, shard)
+            os.replace(tmp_path, f"{shard_dir}/{start:06d}_{end:06d}.npy")
+    if consolidate:
+        consolidate_embedding_bank(bank_path)
+    return bank_path
+
+def embedding_bank_progress(bank_path):
+    """Returns the (start, end) ID ranges of finished and missing shards of a bank being built."""
+    shard_dir = bank_path + ".shards"
+    with open(f"{shard_dir}/manifest.json", 'r') as f:
+        manifest = json.load(f)
+    finished, missing = [], []
+    for start in range(0, manifest["num_items"], manifest["shard_size"]):
+        end = min(start + manifest["shard_size"], manifest["num_items"])
+        (finished if os.path.exists(f"{shard_dir}/{start:06d}_{end:06d}.npy") else missing).append((start, end))
+    return finished, missing
+
+def consolidate_embedding_bank(bank_path):
+    """Merges the finished shards of a bank into the single .npy at bank_path and removes them."""
+    shard_dir = bank_path + ".shards"
+    finished, missing = embedding_bank_progress(bank_path)
+    if missing:
+        raise RuntimeError(f"Cannot consolidate {bank_path}, {len(missing)} of {len(finished) + len(missing)} shards are unfinished")
+    tmp_path = bank_path + ".tmp.npy"
+    bank = None
+    for start, end in tqdm(finished, desc=f"Consolidating {os.path.basename(bank_path)}"):
+        shard = np.load(f"{shard_dir}/{start:06d}_{end:06d}.npy", mmap_mode='r')
+        if bank is None:
+            bank = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=shard.dtype, shape=(finished[-1][1],) + shard.shape[1:])
+        bank[start:end] = shard
+    bank.flush()
+    del bank
+    os.replace(tmp_path, bank_path)
+    shutil.rmtree(shard_dir)
+    return bank_path
+
+def load_embedding_bank(bank_path):
+    """Opens an embedding bank as a read-only memory map."""
+    return np.load(bank_path, mmap_mode='r')
+
+def gather_embedding_bank(bank, nsd_ids, dtype=torch.float32):
+    """Gathers the embeddings of the given NSD image IDs from a bank.
+
+    Each distinct image is read once, in ascending ID order, and expanded to the repeats in
+    nsd_ids afterwards. Works for .npy memory maps and for h5py datasets indexed by NSD image ID.
+    """
+    unique_ids, inverse = np.unique(np.asarray(nsd_ids).astype(np.int64), return_inverse=True)
+    embeddings = torch.from_numpy(np.asarray(bank[unique_ids])).to(dtype)
+    return embeddings[torch.from_numpy(inverse.reshape(-1))]
+
+def create_recon_store(store_path, shape, dtype=np.float32, settings=None):
+    """Preallocates an on-disk store for reconstructions of shape (num_samples, num_reps, ...).
+
+    The store is a directory holding the images in a memory-mapped recons.npy, a manifest.json
+    of its shape, dtype and the run settings, and an append-only index.jsonl with one line per
+    stored (sample, rep) and its seed. Images are flushed to disk as they are appended, so memory
+    use stays flat over a run and a crash only loses the batch being written. An existing store
+    at store_path is replaced.
+
+    Args:
+        store_path (str): Store directory.
+        shape (tuple): (num_samples, num_reps, ...) shape of the stored array.
+        dtype (np.dtype, optional): Storage dtype. Defaults to np.float32, the dtype of the
+            all_recons_{mode}.pt files the evaluation notebooks load.
+        settings (dict, optional): JSON serializable run settings recorded in the manifest.
+
+    Returns:
+        np.memmap: The writable store array, to pass to append_recon_store.
+    """
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.makedirs(store_path)
+    recons = np.lib.format.open_memmap(f"{store_path}/recons.npy", mode='w+', dtype=dtype, shape=tuple(shape))
+    tmp_path = f"{store_path}/manifest.json.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"shape": list(shape), "dtype": str(np.dtype(dtype)), "settings": settings or {}}, f)
+    os.replace(tmp_path, f"{store_path}/manifest.json")
+    open(f"{store_path}/index.jsonl", 'w').close()
+    return recons
+
+def open_recon_store(store_path, settings=None):
+    """Reopens an existing store for appending, e.g. to resume an interrupted run.
+
+    Raises:
+        ValueError: If the store was created with different settings.
+
+    Returns:
+        np.memmap: The writable store array, to pass to append_recon_store.
+    """
+    manifest, _ = recon_store_index(store_path)
+    if manifest["settings"] != (settings or {}):
+        raise ValueError(f"{store_path} was started with {manifest['settings']}, not {settings}; delete it to start over")
+    return np.load(f"{store_path}/recons.npy", mmap_mode='r+')
+
+def append_recon_store(store_path, recons, samples, reps, images, seeds=None):
+    """Writes a block of reconstructions into a store and records it in the index.
+
+    Args:
+        store_path (str): Store directory, see create_recon_store.
+        recons (np.memmap): The store array returned by create_recon_store.
+        samples (sequence of int): Sample indices of the block.
+        reps (sequence of int): Rep indices of the block.
+        images (torch.Tensor or np.ndarray): (len(samples), len(reps), ...) images.
+        seeds (np.ndarray, optional): (len(samples), len(reps)) seeds the images were generated with.
+    """
+    samples, reps = np.asarray(samples, dtype=np.int64), np.asarray(reps, dtype=np.int64)
+    recons[np.ix_(samples, reps)] = torch.as_tensor(images).cpu().numpy()
+    recons.flush()
+    # Index lines are only written once their images are on disk
+    with open(f"{store_path}/index.jsonl", 'a') as f:
+        for i, sample in enumerate(samples):
+            for j, rep in enumerate(reps):
+                seed = None if seeds is None else int(seeds[i][j])
+                f.write(json.dumps({"sample": int(sample), "rep": int(rep), "seed": seed}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def recon_store_index(store_path):
+    """Returns the manifest of a store and the index entries of its stored (sample, rep) pairs."""
+    with open(f"{store_path}/manifest.json", 'r') as f:
+        manifest = json.load(f)
+    entries = []
+    with open(f"{store_path}/index.jsonl", 'r') as f:
+        for line in f:
+            # A crash mid-append can leave a truncated last line, whose images are then rewritten
+            if line.endswith("\n"):
+                entries.append(json.loads(line))
+    return manifest, entries
+
+def load_recon_store(store_path, allow_incomplete=False):
+    """Opens the reconstructions of a store as a (num_samples, num_reps, ...) tensor over a memory map."""
+    manifest, entries = recon_store_index(store_path)
+    num_stored = len({(entry["sample"], entry["rep"]) for entry in entries})
+    num_pairs = manifest["shape"][0] * manifest["shape"][1]
+    if num_stored < num_pairs and not allow_incomplete:
+        raise RuntimeError(f"{store_path} is incomplete, {num_stored} of {num_pairs} reconstructions are stored")
+    # Copy-on-write, so the tensor is writable without touching the file
+    return torch.from_numpy(np.load(f"{store_path}/recons.npy", mmap_mode='c'))
+
 def create_snr_betas(subject=1, data_type=torch.float16, data_path="../dataset/", threshold=-1.0):
-    
+
     if threshold != -1.0:
         create_whole_region_unnormalized(subject = subject, include_heldout=True, mask_nsd_general=False, data_path=data_path)
         create_whole_region_normalized(subject = subject, include_heldout=True, mask_nsd_general=False, data_path=data_path)
-        # Load the tensor from the HDF5 file
-        with h5py.File(f'{data_path}/betas_all_whole_brain_subj{subject:02d}_fp32_renorm.hdf5', 'r') as f:
-            betas = f['betas'][:]
-            betas = torch.from_numpy(betas).to("cpu")
-    
+        # Open the memory-mapped beta store for the HDF5 file
+        betas = load_beta_store(f'{data_path}/betas_all_whole_brain_subj{subject:02d}_fp32_renorm.hdf5')
+
         snr_mask = calculate_snr_mask(subject, threshold, betas=betas, data_path=data_path)
-        
+
         # Filter out the zero columns
-        betas = betas[:, snr_mask]
-        
-    else:      
-        with h5py.File(f'{data_path}/betas_all_subj{subject:02d}_fp32_renorm.hdf5', 'r') as f:
-            betas = f['betas'][:]
-            betas = torch.from_numpy(betas).to("cpu")
-        
-    return betas.to(data_type)
+        return mask_betas(betas, snr_mask, dtype=data_type)
+
+    else:
+        betas = load_beta_store(f'{data_path}/betas_all_subj{subject:02d}_fp32_renorm.hdf5')
+
+    return mask_betas(betas, dtype=data_type)
 
-def load_nsd(subject, betas=None, num_sessions=40, data_path="../dataset/"):
-    # Load betas if not provided
+def load_nsd(subject, betas=None, num_sessions=40, data_path="../dataset/", use_cache=True):
+    # Lazily open the memory-mapped betas if not provided
     if betas is None:
-        with h5py.File(f'{data_path}/betas_all_subj{subject:02d}_fp32_renorm.hdf5', 'r') as f:
-            betas = f['betas'][:]
-            betas = torch.from_numpy(betas).to("cpu")
+        betas = load_beta_store(f'{data_path}/betas_all_subj{subject:02d}_fp32_renorm.hdf5')
 
+    # The scan IDs are cached (see nsd_scan_ids), the betas are gathered from the store every time
+    valid_scan_ids_train, valid_nsd_ids_train, scan_ids_test, valid_mask_test, test_nsd_ids = nsd_scan_ids(
+        subject, num_sessions=num_sessions, num_scans=betas.shape[0], data_path=data_path, use_cache=use_cache
+    )
+
+    # Extract the corresponding brain activity data for training data
+    x_train = gather_betas(betas, valid_scan_ids_train)
+
+    # Extract betas for valid scan IDs, leaving missing repeats as zeros
+    x_test = gather_betas_masked(betas, scan_ids_test, valid_mask_test, fill_value=0.0)
+
+    return x_train, valid_nsd_ids_train, x_test, test_nsd_ids
+
+@cached_loader(_nsd_scan_ids_sources)
+def nsd_scan_ids(subject, num_sessions=40, num_scans=30000, data_path="../dataset/"):
+    """Derives the scan IDs load_nsd gathers from nsd_stim_info_merged.csv, for a beta store of num_scans scans.
+
+    Returns:
+        tuple: (train scan IDs, their NSD IDs, (num_test, 3) test scan IDs with -1 for missing
+        repeats, the mask of valid test repeats, test NSD IDs).
+    """
     # Load stimulus descriptions
     stim_descriptions = pd.read_csv(
         f"{data_path}/nsddata/experiments/nsd/nsd_stim_info_merged.csv", index_col=0
@@ -1196,15 +1673,12 @@ def load_nsd(subject, betas=None, num_sessions=40, data_path="../dataset/"):
     valid_mask_train = (
         (~np.isnan(flat_scan_ids_train))
         & (flat_scan_ids_train >= 0)
-        & (flat_scan_ids_train < betas.shape[0])
+        & (flat_scan_ids_train < num_scans)
         & (flat_scan_ids_train < num_sessions * 750)
     )
     valid_scan_ids_train = flat_scan_ids_train[valid_mask_train].astype(int)
     valid_nsd_ids_train = repeated_nsd_ids_train[valid_mask_train].astype(int)
 
-    # Extract the corresponding brain activity data for training data
-    x_train = betas[valid_scan_ids_train]
-
     # Filter test data (include shared1000 trials)
     subj_test = stim_descriptions[
         (stim_descriptions[f"subject{subject}"] != 0) & (stim_descriptions["shared1000"] == True)
@@ -1217,25 +1691,14 @@ def load_nsd(subject, betas=None, num_sessions=40, data_path="../dataset/"):
     valid_mask_test = (
         (~np.isnan(scan_ids_test))
         & (scan_ids_test >= 0)
-        & (scan_ids_test < betas.shape[0])
+        & (scan_ids_test < num_scans)
     )
     scan_ids_test[~valid_mask_test] = -1  # Mark invalid indices with -1
 
-    # Prepare to extract betas for test data
-    num_test_trials, num_repeats = scan_ids_test.shape
-    x_test = torch.zeros((num_test_trials, num_repeats, betas.shape[1]), dtype=betas.dtype)
-
-    # Extract betas for valid scan IDs
-    for i in range(num_test_trials):
-        for j in range(num_repeats):
-            scan_id = scan_ids_test[i, j]
-            if scan_id >= 0:
-                x_test[i, j] = betas[int(scan_id)]
-
     # Get nsd IDs for test data
     test_nsd_ids = subj_test["nsdId"].values.astype(int)
 
-    return x_train, valid_nsd_ids_train, x_test, test_nsd_ids
+    return valid_scan_ids_train, valid_nsd_ids_train, scan_ids_test, valid_mask_test, test_nsd_ids
 
 def load_subject_masks(subject_ids, data_path, nsd_general=False):
     subject_masks = {}
@@ -1277,6 +1740,13 @@ def load_subject_masks(subject_ids, data_path, nsd_general=False):
 
 
 def mask_whole_brain_on_top_n_rois(excluded_subject, betas, top_n_rois, samplewise, nsd_general, data_path): 
+    # Apply mask to betas
+    return betas[..., top_n_rois_mask(excluded_subject, top_n_rois, samplewise, nsd_general, data_path)]
+
+
+@cached_loader(_top_n_rois_sources)
+def top_n_rois_mask(excluded_subject, top_n_rois, samplewise, nsd_general, data_path):
+    """Returns the boolean whole-brain voxel mask of the top_n_rois rank-ordered ROIs of a subject."""
     print(f"mask_whole_brain_on_top_n_rois: nsdgeneral {nsd_general}, top n rois {top_n_rois}, samplewise {samplewise}")
     subject_ids = [f'subj0{i}' for i in range(1, 9)]
     subject_masks = load_subject_masks(subject_ids, data_path, nsd_general)
@@ -1306,35 +1776,29 @@ def mask_whole_brain_on_top_n_rois(excluded_subject, betas, top_n_rois, samplewi
         roi_mask = np.logical_or(roi_mask, excluded_subject_mask[rank_order_rois_keys[i]])
     
     # Convert to PyTorch tensor
-    roi_mask = torch.from_numpy(roi_mask).to("cpu")
-    
-    # Apply mask to betas
-    betas = betas[..., roi_mask]
-    
-    return betas
+    return torch.from_numpy(roi_mask).to("cpu")
 
 
 def load_subject_based_on_rank_order_rois(excluded_subject=1, data_type=torch.float16, top_n_rois=-1, samplewise=False, nsd_general=False, data_path="../dataset/"):
     
     if top_n_rois != -1.0:
         
-        # Load the betas for the excluded subject
-        with h5py.File(f'{data_path}/betas_all_whole_brain_subj{excluded_subject:02d}_fp32_renorm.hdf5', 'r') as f:
-            betas = f['betas'][:]
-            betas = torch.from_numpy(betas).to("cpu")
+        # Open the memory-mapped betas for the excluded subject
+        betas = load_beta_store(f'{data_path}/betas_all_whole_brain_subj{excluded_subject:02d}_fp32_renorm.hdf5')
     
-        betas = mask_whole_brain_on_top_n_rois(excluded_subject, betas, top_n_rois, samplewise, nsd_general=nsd_general, data_path=data_path)
+        roi_mask = top_n_rois_mask(excluded_subject, top_n_rois, samplewise, nsd_general=nsd_general, data_path=data_path)
+        # Mask and convert a chunk of rows at a time, so the whole-brain store is never loaded at once
+        return mask_betas(betas, roi_mask, dtype=data_type)
     
     else:              
-        # Load betas without applying any ROI masking
-        with h5py.File(f'{data_path}/betas_all_subj{excluded_subject:02d}_fp32_renorm.hdf5', 'r') as f:
-            betas = f['betas'][:]
-            betas = torch.from_numpy(betas).to("cpu")
+        # Open betas without applying any ROI masking
+        betas = load_beta_store(f'{data_path}/betas_all_subj{excluded_subject:02d}_fp32_renorm.hdf5')
     
-    return betas.to(data_type)
+    return mask_betas(betas, dtype=data_type)
 
 
-def calculate_snr_mask(subject, threshold, betas=None, data_path="../dataset/"):
+@cached_loader(_snr_mask_sources)
+def calculate_snr_mask(subject, threshold, betas=None, data_path="../dataset/", chunk_images=1024):
     
     if betas is None:
         beta_file = f"{data_path}/preprocessed_data/subject{subject}/whole_brain_include_heldout.pt"
@@ -1361,31 +1825,27 @@ def calculate_snr_mask(subject, threshold, betas=None, data_path="../dataset/"):
     scanIds = np.where(np.isnan(scanIds), -1, scanIds).astype(int)
     valid_mask = (scanIds >= 0) & (scanIds < x.shape[0])
 
-    # Flatten arrays for advanced indexing
-    flat_scanIds = scanIds.flatten()
-    flat_valid_mask = valid_mask.flatten()
-
-    # Indices of valid scan IDs
-    valid_indices = np.where(flat_valid_mask)[0]
-    valid_scanIds = flat_scanIds[valid_indices]
-
-    # Map valid_indices back to (i, j) indices
-    i_indices = valid_indices // 3
-    j_indices = valid_indices % 3
-
-    # Retrieve corresponding x values
-    x_values = x[valid_scanIds]
-
-    # Initialize x_train tensor
-    x_train = torch.zeros((subj_train.shape[0], 3, x.shape[1]), dtype=x.dtype)
-
-    # Assign x_values to x_train at the correct positions
-    x_train[i_indices, j_indices, :] = x_values
-                            
-    snr, signal, noise = calculate_snr(x_train)
+    # Accumulate the SNR statistics over chunks of training images, so that their betas, nearly the
+    # whole store, are never gathered at once; missing repeats count as zeros, as in calculate_snr
+    num_images = len(scanIds)
+    mean_sum = torch.zeros(x.shape[1], dtype=torch.float64)
+    mean_sq_sum = torch.zeros(x.shape[1], dtype=torch.float64)
+    noise_sum = torch.zeros(x.shape[1], dtype=torch.float64)
+    for start in range(0, num_images, chunk_images):
+        x_chunk = gather_betas_masked(x, scanIds[start:start + chunk_images], valid_mask[start:start + chunk_images]).double()
+        averaged = x_chunk.mean(dim=1)
+        mean_sum += averaged.sum(dim=0)
+        mean_sq_sum += (averaged ** 2).sum(dim=0)
+        noise_sum += torch.var(x_chunk, dim=1).sum(dim=0)
+    signal = (mean_sq_sum - mean_sum ** 2 / num_images) / (num_images - 1)
+    noise = noise_sum / num_images
+    snr = torch.nan_to_num(signal / noise)
     condition = snr > threshold
-    snr_tensor = torch.where(condition, x, torch.tensor(0.0))
-    snr_mask = (snr_tensor != 0.0).any(dim=0)
+    # Drop voxels that are zero in every scan, reading the betas in row chunks
+    nonzero = torch.zeros(x.shape[1], dtype=torch.bool)
+    for start in range(0, x.shape[0], 2048):
+        nonzero |= (x[start:start + 2048] != 0.0).any(dim=0)
+    snr_mask = condition & nonzero
 
     return snr_mask
 
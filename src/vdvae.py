@@ -4,6 +4,7 @@ import torch
 import numpy as np
 from image_utils import *
 from model_utils import *
+from vae_helpers import sample_from_discretized_mix_logistic
 from PIL import Image
 import torchvision.transforms as T
 
@@ -25,6 +26,11 @@ class VDVAE():
         self.device = device
         H, self.preprocess_fn = set_up_data(H, device=self.device)
         self.ema_vae = load_vaes(H, device=self.device)
+        # The flattened latent holds the z of the first 31 decoder blocks, with these shapes and offsets
+        self.latent_shapes = [tuple(int(d) for d in shape) for shape in torch.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), "vdvae", "vdvae_shapes.pt"))]
+        self.latent_offsets = np.concatenate([[0], np.cumsum([np.prod(shape) for shape in self.latent_shapes])]).astype(int)
+        self.num_latent_layers = len(self.latent_shapes)
+        self.latent_dim = int(self.latent_offsets[-1])
         
     def sample_from_hier_latents(self, latents):
         layers_num=len(latents)
@@ -35,41 +41,91 @@ class VDVAE():
 
     # Transfor latents from flattened representation to hierarchical
     def latent_transformation(self, latents):
-        shapes=torch.load("vdvae/vdvae_shapes.pt")
-        layer_dims = np.array([2**4,2**4,2**8,2**8,2**8,2**8,2**10,2**10,2**10,2**10,2**10,2**10,2**10,2**10,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**14])
         transformed_latents = []
-        for i in range(31):
-            t_lat = latents[:,layer_dims[:i].sum():layer_dims[:i+1].sum()]
-            #std_norm_test_latent = (t_lat - np.mean(t_lat,axis=0)) / np.std(t_lat,axis=0)
-            #renorm_test_latent = std_norm_test_latent * np.std(kamitani_latents[i][num_test:].reshape(num_train,-1),axis=0) + np.mean(kamitani_latents[i][num_test:].reshape(num_train,-1),axis=0)
-            c,h,w=shapes[i]
+        for i, (c, h, w) in enumerate(self.latent_shapes):
+            t_lat = latents[:,self.latent_offsets[i]:self.latent_offsets[i+1]]
             transformed_latents.append(t_lat.reshape(len(latents),c,h,w))
         return transformed_latents
     
-    def embed_latent(self, image):
-        img = T.functional.resize(image,(64,64))
-        img = torch.tensor(np.array(img)).float()[None,:,:,:]
-        
-        latents = []
-        data_input, _ = self.preprocess_fn(img)
+    def prepare_images(self, images):
+        """Converts images to the 64x64 channels-last [0, 255] batch the VDVAE encoder expects.
+
+        PIL images are resized with PIL as before. Tensor batches of shape (N, 3, H, W) or (3, H, W),
+        either uint8 or floating point in [0, 1], are resized on the device without a PIL round trip.
+        Floating point inputs are quantized to 8 bits first, as create_git_features does, so that they
+        match the uint8 pixels of the PIL path.
+        """
+        if isinstance(images, Image.Image):
+            images = [images]
+        if isinstance(images, list):
+            return torch.stack([torch.tensor(np.array(T.functional.resize(image, (64, 64)))) for image in images]).float()
+        images = images.to(self.device, non_blocking=True)
+        if images.dim() == 3:
+            images = images.unsqueeze(0)
+        images = images.float() if images.dtype == torch.uint8 else (images.float() * 255).floor()
+        images = T.functional.resize(images, (64, 64), antialias=True)
+        return images.permute(0, 2, 3, 1)
+
+    def embed_latent(self, images):
+        """Encodes a batch of images to flattened 91168-dim VDVAE latents.
+
+        The z of each of the first 31 decoder blocks is written straight into a preallocated
+        buffer on the device. The decoder blocks after them do not affect those latents, so
+        they are skipped.
+
+        Args:
+            images (PIL.Image.Image, list, or torch.Tensor): A PIL image, a list of them, or a
+                (N, 3, H, W) or (3, H, W) tensor, uint8 or floating point in [0, 1].
+
+        Returns:
+            torch.Tensor: float32 latents of shape (N, 91168) on self.device.
+        """
+        data_input, _ = self.preprocess_fn(self.prepare_images(images))
+        latents = torch.empty((len(data_input), self.latent_dim), device=data_input.device)
         with torch.no_grad():
             activations = self.ema_vae.encoder.forward(data_input)
-            _, stats = self.ema_vae.decoder.forward(activations, get_latents=True)
-            #recons = ema_vae.decoder.out_net.sample(px_z)
-            batch_latent = []
-            for j in range(31):
-                batch_latent.append(stats[j]['z'].cpu().numpy().reshape(len(data_input),-1))
-            latents.append(np.hstack(batch_latent))
-        latents = np.concatenate(latents)
-        latents = torch.from_numpy(latents)
+            xs = {a.shape[2]: a for a in self.ema_vae.decoder.bias_xs}
+            offset = 0
+            for block in self.ema_vae.decoder.dec_blocks[:self.num_latent_layers]:
+                xs, stats = block(xs, activations, get_latents=True)
+                z = stats['z'].reshape(len(data_input), -1)
+                latents[:, offset:offset + z.shape[1]] = z
+                offset += z.shape[1]
         return latents
 
+    def decode(self, latents):
+        """Decodes flattened latents of shape (N, 91168) to 64x64 images in one decoder pass.
+
+        Returns:
+            torch.Tensor: float32 images in [0, 1] of shape (N, 3, 64, 64) on self.device, quantized
+            to 8 bits like the PIL images of reconstruct.
+        """
+        latents = torch.as_tensor(latents).reshape(-1, self.latent_dim)
+        samp = self.sample_from_hier_latents(self.latent_transformation(latents))
+        with torch.no_grad():
+            px_z = self.ema_vae.decoder.forward_manual_latents(len(latents), samp, t=None)
+            # DmolNet.sample without its trip through numpy
+            out_net = self.ema_vae.decoder.out_net
+            im = sample_from_discretized_mix_logistic(out_net.forward(px_z), out_net.H.num_mixtures)
+            im = ((im + 1.0) * 127.5).clamp(0, 255).floor()
+        return im.permute(0, 3, 1, 2) / 255
+
+    def reconstruct_batch(self, latents, size=768):
+        """Decodes a batch of latents and upsamples it on the device.
+
+        Args:
+            latents (torch.Tensor or np.ndarray): Flattened latents of shape (N, 91168).
+            size (int, optional): Output resolution. Defaults to 768.
+
+        Returns:
+            torch.Tensor: float32 images in [0, 1] of shape (N, 3, size, size) on self.device. Bicubic
+            resizing stands in for the LANCZOS filter of the PIL path.
+        """
+        images = self.decode(latents)
+        return T.functional.resize(images, (size, size), interpolation=T.InterpolationMode.BICUBIC, antialias=True).clamp(0, 1)
+
     def reconstruct(self, latents):
-        input_latent = self.latent_transformation(latents)
-        samp = self.sample_from_hier_latents(input_latent)
-        px_z = self.ema_vae.decoder.forward_manual_latents(len(samp[0]), samp, t=None)
-        sample_from_latent = self.ema_vae.decoder.out_net.sample(px_z)
-        im = sample_from_latent
-        im = Image.fromarray(im[0])
-        im = im.resize((768,768),resample=Image.Resampling.LANCZOS)
-        return im
\ No newline at end of file
+        """PIL wrapper around decode, returning a 768x768 LANCZOS-upsampled PIL image, or a list of them for several latents."""
+        images = (self.decode(latents) * 255).round().byte().permute(0, 2, 3, 1).cpu().numpy()
+        images = [Image.fromarray(im).resize((768,768),resample=Image.Resampling.LANCZOS) for im in images]
+        return images[0] if len(images) == 1 else images